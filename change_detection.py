@@ -0,0 +1,113 @@
+"""
+Only refresh the players whose data has changed since the last run.
+Each player's static data (injury news, price etc.) and their team's upcoming fixtures are
+fingerprinted and compared to a snapshot saved by the previous run. Players with the same
+fingerprint reuse their previous predictions, everyone else has their fixture data
+refetched and their points re-predicted.
+"""
+import constants
+import hashlib
+import json
+import logging
+import neural_network
+import points
+import web_service
+
+logger = logging.getLogger()
+
+# The predicted fields stored for each player, and reused while their fingerprint is the same
+PREDICTED_FIELDS = [
+    'expected_points',
+    'expected_points_this_gameweek',
+    'expected_points_by_gameweek',
+    'expected_points_variance',
+    'expected_points_this_gameweek_variance',
+    'expected_points_variance_by_gameweek',
+    'injury_multiplier',
+    'past_fixture_multiplier'
+]
+
+
+def load_snapshot(path=constants.ELEMENT_SNAPSHOT_PATH):
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_snapshot(snapshot, path=constants.ELEMENT_SNAPSHOT_PATH):
+    with open(path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+
+
+def get_team_fixtures(all_fixtures):
+    """
+    Get each team's fixtures within the prediction horizon, as a list of (fixture id, event).
+    """
+    first_event = constants.NEXT_EVENT['id']
+    last_event = first_event + constants.PREDICTION_HORIZON - 1
+    team_fixtures = {}
+    for fixture in all_fixtures:
+        if fixture['event'] is not None and first_event <= fixture['event'] <= last_event:
+            for team in (fixture['team_h'], fixture['team_a']):
+                team_fixtures.setdefault(team, []).append((fixture['id'], fixture['event']))
+    return team_fixtures
+
+
+def get_fingerprint(player, team_fixtures):
+    """
+    Fingerprint everything in the static data that could change a player's predicted points.
+    """
+    fields = [player.get(field) for field in constants.ELEMENT_FINGERPRINT_FIELDS]
+    fixtures = sorted(team_fixtures.get(player['team'], []))
+    return hashlib.sha1(json.dumps([fields, fixtures]).encode()).hexdigest()
+
+
+def predict_changed_players(all_players, fixtures=None):
+    """
+    Predict the expected points for every player, reusing the previous run's predictions
+    for any player whose fingerprint hasn't changed.
+    """
+    snapshot = load_snapshot()
+    model_hash = neural_network.get_model_hash()
+    # If the gameweek or the model has changed, every prediction is out of date
+    if snapshot.get('event') != constants.NEXT_EVENT['id'] or snapshot.get('model') != model_hash:
+        logger.debug('Snapshot is for a different event or model, refreshing every player')
+        snapshot = {}
+    previous = snapshot.get('players', {})
+    team_fixtures = get_team_fixtures(web_service.get_all_fixtures())
+
+    changed_players = []
+    fingerprints = {}
+    for player in all_players:
+        fingerprint = get_fingerprint(player, team_fixtures)
+        fingerprints[player['id']] = fingerprint
+        cached = previous.get(str(player['id']))
+        # snapshots from before a field was added are refreshed
+        if cached is not None and cached['fingerprint'] == fingerprint and all(field in cached for field in PREDICTED_FIELDS):
+            constants.PLAYERS[player['id']] = player
+            for field in PREDICTED_FIELDS:
+                player[field] = cached[field]
+        else:
+            changed_players.append(player)
+            points.INJURY_MULTIPLIERS.pop(player['id'], None)
+            points.PAST_FIXTURE_MULTIPLIERS.pop(player['id'], None)
+            if fixtures is not None and cached is not None:
+                fixtures.pop(player['id'], None)
+
+    logger.info('Refreshing {} players, skipping {} unchanged players'.format(
+        len(changed_players), len(all_players) - len(changed_players)))
+    points.predict_all_players(changed_players, fixtures)
+
+    save_snapshot({
+        'event': constants.NEXT_EVENT['id'],
+        'model': model_hash,
+        'players': {
+            str(player['id']): dict(
+                {field: player[field] for field in PREDICTED_FIELDS},
+                fingerprint=fingerprints[player['id']]
+            ) for player in all_players
+        }
+    })
+    return all_players
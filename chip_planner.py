@@ -0,0 +1,162 @@
+"""
+Evaluate which chip (if any) to play this gameweek.
+The squad/lineup problem is solved for each chip scenario in parallel worker processes,
+all from the same table of predicted points, and each chip's expected points gain over the
+prediction horizon is compared with not playing a chip and making the best transfers for the horizon.
+    - wildcard: unlimited free transfers, picking the best squad over the prediction horizon.
+    - freehit: unlimited free transfers for this gameweek only, then the squad goes back to the current squad.
+    - bboost: the bench's points also count this gameweek.
+    - 3xc: the captain's points are tripled rather than doubled this gameweek.
+The bench boost and triple captain use the same squad as not playing a chip, so they're
+valued from that solve rather than solved separately.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import constants
+import linear_solver
+import logging
+import multiprocessing
+import time
+
+logger = logging.getLogger()
+
+# Chips that change the squad and need their own solve
+SQUAD_CHIPS = ['wildcard', 'freehit']
+# The expected points each scenario's squad is solved for. The free hit squad only plays this gameweek
+SCENARIO_POINTS = {None: 'expected_points', 'wildcard': 'expected_points', 'freehit': 'expected_points_this_gameweek'}
+
+
+def get_available_chips(current_squad):
+    """
+    Get the names of the chips that can be played, from the my-team payload.
+    """
+    return [chip['name'] for chip in current_squad['chips'] if chip['status_for_entry'] == 'available']
+
+
+def get_transfer_cost(current_squad, new_squad):
+    """
+    Get the points deducted for the transfers from the current squad to the new squad.
+    """
+    current_squad_ids = [player['element'] for player in current_squad['picks']]
+    num_changes = len([player for player in new_squad if player['id'] not in current_squad_ids])
+    free_transfers = max(0, current_squad['transfers']['limit'] or 0)
+    return max(0, num_changes - free_transfers) * constants.TRANSFER_POINT_DEDUCTION
+
+
+def get_lineup_points(squad, starting_lineup, key):
+    """
+    Get the expected points of the starting lineup (including the captain's double points)
+    and of the bench, using the given expected points key.
+    """
+    players = {player['id']: player for player in squad}
+    starting_points = bench_points = captain_points = 0
+    for pick in starting_lineup['picks']:
+        points = players[pick['element']][key]
+        if pick['position'] <= constants.STARTING_SIZE:
+            starting_points += points
+            if pick['is_captain'] == 'true':
+                captain_points = points
+        else:
+            bench_points += points
+    return starting_points + captain_points, bench_points, captain_points
+
+
+def init_worker():
+    # Only log warnings from the workers, else the lineups are logged for every scenario
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def solve_scenario(chip, all_players, current_squad):
+    """
+    Solve the squad and starting lineup for a single chip scenario (None for no chip).
+    """
+    if chip == 'wildcard':
+        budget = current_squad['transfers']['value'] + current_squad['transfers']['bank']
+        new_squad = linear_solver.select_squad_ignore_transfers(budget, all_players)
+    else:
+        new_squad = linear_solver.select_squad(current_squad, chip == 'freehit', all_players, points_key=SCENARIO_POINTS[chip])
+    return chip, new_squad, linear_solver.select_starting(new_squad)
+
+
+def solve_current_lineup(all_players, current_squad):
+    """
+    Solve the starting lineup for the current squad, which is played again after a free hit.
+    """
+    current_squad_ids = [pick['element'] for pick in current_squad['picks']]
+    squad = [player for player in all_players if player['id'] in current_squad_ids]
+    return squad, linear_solver.select_starting(squad)
+
+
+def get_horizon_points(squad, starting_lineup):
+    """
+    Get the starting lineup's expected points over the prediction horizon, and in the gameweeks after this one.
+    """
+    horizon_points = get_lineup_points(squad, starting_lineup, 'expected_points')[0]
+    return horizon_points, horizon_points - get_lineup_points(squad, starting_lineup, 'expected_points_this_gameweek')[0]
+
+
+def plan_chips(current_squad, all_players):
+    """
+    Work out the expected points gain of each available chip and recommend which to play.
+    Returns a dict with the gain for each chip, the recommended chip (or None)
+    and the squad and starting lineup to use with it.
+    """
+    start = time.perf_counter()
+    available_chips = get_available_chips(current_squad)
+    logger.info('Available chips: {}'.format(available_chips))
+    scenarios = [None] + [chip for chip in SQUAD_CHIPS if chip in available_chips]
+    # Only send the workers what they need to solve
+    player_table = [{
+        'id': player['id'],
+        'element_type': player['element_type'],
+        'team': player['team'],
+        'now_cost': player['now_cost'],
+        'first_name': player['first_name'],
+        'second_name': player['second_name'],
+        'expected_points': float(player['expected_points']),
+        'expected_points_this_gameweek': float(player['expected_points_this_gameweek']),
+        'expected_points_variance': float(player.get('expected_points_variance', 0)),
+        'expected_points_this_gameweek_variance': float(player.get('expected_points_this_gameweek_variance', 0))
+    } for player in all_players]
+
+    # Fork where we can so the workers don't reload the model and dataset
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with ProcessPoolExecutor(max_workers=len(scenarios) + 1, mp_context=context, initializer=init_worker) as executor:
+        futures = [executor.submit(solve_scenario, chip, player_table, current_squad) for chip in scenarios]
+        if 'freehit' in scenarios:
+            current_lineup = executor.submit(solve_current_lineup, player_table, current_squad)
+        results = {chip: (new_squad, starting_lineup) for chip, new_squad, starting_lineup in (future.result() for future in futures)}
+
+    # Value everything over the prediction horizon against not playing a chip
+    squad, starting_lineup = results[None]
+    horizon_points = get_horizon_points(squad, starting_lineup)[0] - get_transfer_cost(current_squad, squad)
+    bench_points, captain_points = get_lineup_points(squad, starting_lineup, 'expected_points_this_gameweek')[1:]
+    gains = {}
+    # only this gameweek changes, so the rest of the horizon is the same as not playing a chip
+    if 'bboost' in available_chips:
+        gains['bboost'] = bench_points
+    if '3xc' in available_chips:
+        gains['3xc'] = captain_points
+    if 'freehit' in results:
+        # the free hit squad plays this gameweek, then the current squad plays the rest without any transfers
+        freehit_points = get_lineup_points(*results['freehit'], 'expected_points_this_gameweek')[0]
+        gains['freehit'] = freehit_points + get_horizon_points(*current_lineup.result())[1] - horizon_points
+    if 'wildcard' in results:
+        gains['wildcard'] = get_horizon_points(*results['wildcard'])[0] - horizon_points
+    for chip, gain in gains.items():
+        logger.info('Expected points gain from {} over {} gameweeks: {:.2f}'.format(chip, constants.PREDICTION_HORIZON, gain))
+
+    chip = max(gains, key=gains.get) if gains else None
+    if chip is None or gains[chip] < constants.CHIP_MIN_GAIN:
+        chip = None
+    logger.info('Recommended chip: {}'.format(chip))
+    logger.info('Evaluated {} chip scenarios in {:.2f}s'.format(len(scenarios), time.perf_counter() - start))
+
+    squad, starting_lineup = results[chip if chip in results else None]
+    # Return the full player dicts rather than the worker's copies
+    players = {player['id']: player for player in all_players}
+    return {
+        'gains': gains,
+        'chip': chip,
+        'squad': [players[player['id']] for player in squad],
+        'starting': starting_lineup
+    }
@@ -1,20 +1,73 @@
 """
 Some useful constants for the fantasy premier league
 """
+import os
+import urllib.parse
+
 # URLs needed
-FANTASY_URL = 'https://fantasy.premierleague.com'
-FANTASY_API_URL = 'https://fantasy.premierleague.com/api/bootstrap-static/'
-FANTASY_API_DYNAMIC_URL = 'https://fantasy.premierleague.com/api/me/'
-FANTASY_PLAYER_API_URL = 'https://fantasy.premierleague.com/api/element-summary/'
+# FANTASY_PL_URL can point at a local stub of the API for testing
+FANTASY_URL = os.environ.get('FANTASY_PL_URL', 'https://fantasy.premierleague.com')
+# The domain the site's cookies (e.g. the CSRF token) are set on
+FANTASY_DOMAIN = urllib.parse.urlparse(FANTASY_URL).hostname
+FANTASY_API_URL = FANTASY_URL + '/api/bootstrap-static/'
+FANTASY_API_DYNAMIC_URL = FANTASY_URL + '/api/me/'
+FANTASY_PLAYER_API_URL = FANTASY_URL + '/api/element-summary/'
+FANTASY_FIXTURES_API_URL = FANTASY_URL + '/api/fixtures/'
 LOGIN_URL = 'https://users.premierleague.com/accounts/login/'
-SQUAD_URL = 'https://fantasy.premierleague.com/api/my-team/'
-TRANSFER_URL = 'https://fantasy.premierleague.com/api/transfers/'
+SQUAD_URL = FANTASY_URL + '/api/my-team/'
+TRANSFER_URL = FANTASY_URL + '/api/transfers/'
 
 # Other constants
 CURRENT_SEASON = '2024-25'
-NUM_CHANGES = 0
 TOTAL_GAMES_IN_SEASON = 38
 DEFAULT_MODEL_PATH = './data/model.pt'
+TOKEN_CACHE_PATH = './.token_cache.json'
+ELEMENT_SNAPSHOT_PATH = './.element_snapshot.json'
+PREDICTION_CACHE_PATH = './.prediction_cache.sqlite'
+# Each run's players, predictions and solver inputs/outputs are saved in a directory under here
+RUN_SNAPSHOT_DIR = './snapshots'
+# Bump when the layout of the run snapshots changes
+RUN_SNAPSHOT_VERSION = 2
+# Number of gameweeks to predict the expected points over
+PREDICTION_HORIZON = 3
+# MC dropout: the number of stochastic passes used to estimate the variance of each prediction
+MC_DROPOUT_SAMPLES = 32
+# Fewer passes are used if the passes for the whole player pool (about 700 players' fixtures
+# over the prediction horizon) in one batch would take longer than this many seconds
+MC_DROPOUT_LATENCY_BUDGET = 1.0
+MC_DROPOUT_POOL_ROWS = 700 * PREDICTION_HORIZON
+# Points deducted per unit of variance in a player's predicted points when selecting players
+RISK_AVERSION = 0
+# Fields from the static player data that affect the predicted points
+ELEMENT_FINGERPRINT_FIELDS = [
+    'news',
+    'chance_of_playing_next_round',
+    'chance_of_playing_this_round',
+    'now_cost',
+    'event_points',
+    'points_per_game',
+    'element_type',
+    'team',
+    'status'
+]
+# Fields from the static player data that are kept for the rest of the run
+PLAYER_FIELDS = ELEMENT_FINGERPRINT_FIELDS + [
+    'id',
+    'first_name',
+    'second_name',
+    'web_name'
+]
+# Fields from a player's upcoming fixtures that are needed to predict their points
+FIXTURE_FIELDS = ['id', 'event', 'is_home', 'team_h', 'team_a', 'kickoff_time']
+# Treat cached bearer tokens as expired this many seconds early
+TOKEN_EXPIRY_MARGIN = 300
+
+# Daemon mode timings (seconds)
+DAEMON_POLL_INTERVAL = 15 * 60
+# How long before the deadline to fetch the data and predict the points
+DAEMON_PREFETCH_LEAD = 6 * 60 * 60
+# How long before the deadline to refresh availability and make the final solve
+DAEMON_FINAL_LEAD = 30 * 60
 
 # Data we grab from the web services
 NEXT_EVENT = None
@@ -35,3 +88,5 @@ SQUAD_NUM_GOALKEEPERS = 2
 SQUAD_NUM_MIDFIELDERS = 5
 INITIAL_TEAM_VALUE = 1000
 TRANSFER_POINT_DEDUCTION = 4
+# Only recommend playing a chip if it's expected to gain at least this many points
+CHIP_MIN_GAIN = 10
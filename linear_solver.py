@@ -5,24 +5,128 @@ import constants
 import locale
 import logging
 import platform
-import points
 import pulp
-import web_service
+import threading
+import time
 
 logger = logging.getLogger()
-locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
+try:
+    locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
+except locale.Error:
+    # the locale isn't installed everywhere (e.g. slim containers), so carry on with the default
+    logger.warning('Could not set the locale to en_US.UTF-8, using the default locale')
 
-def select_squad(current_squad, ignore_transfer_cost):
+def format_currency(value):
     """
-    Given the current squad, calculate the best possible squad for next week.
+    Format a value as currency, falling back to a plain number if the locale doesn't support it.
+    """
+    try:
+        return locale.currency(value)
+    except ValueError:
+        return '{:.2f}'.format(value)
+
+def get_risk_adjusted_points(player, key):
+    """
+    Get a player's expected points (the key, e.g. expected_points_this_gameweek) less
+    constants.RISK_AVERSION times the variance of the prediction, to prefer the more certain players.
+    """
+    return player[key] - constants.RISK_AVERSION * player.get(key + '_variance', 0)
+
+def get_predicted_players():
+    """
+    Fetch every player and predict their expected points.
+    Only players that have changed since the last run are re-predicted.
+    """
+    # imported here, so solving from a snapshot doesn't load the model
+    import change_detection
+    import points
+    import web_service
+    return change_detection.predict_changed_players(points.reduce_players(web_service.get_all_player_data()))
+
+
+# Squad problems that have already been built, keyed by everything except the expected points,
+# so re-solving after the predictions change only replaces the objective
+SQUAD_PROBLEMS = {}
+SQUAD_PROBLEMS_LOCK = threading.Lock()
+# Only keep the most recently built problems, e.g. the daemon builds new ones every gameweek
+SQUAD_PROBLEMS_MAX_SIZE = 8
+
+
+def solve_cold(problem):
+    """
+    Solve the problem with the default solver.
+    """
+    # On the pi, we need to use the GLPK solver.
+    if platform.system() == 'Linux':
+        problem.solve(pulp.GLPK_CMD(msg=0))
+    else:
+        # not just solve(), which would use the solver a reused problem was last solved with
+        problem.solve(pulp.LpSolverDefault)
+
+
+def solve(problem, warm_start=False):
+    """
+    Solve the problem, returning how long it took.
+    GLPK can't be warm started from the variables' initial values, so CBC is used for
+    warm starts. The bundled CBC binary doesn't run everywhere (e.g. on the pi, where PuLP
+    picks an x86 binary), so the default solver is used if it fails.
+    """
+    start = time.perf_counter()
+    # CBC gets the sign of a maximisation's starting objective wrong, so a start with a negative
+    # objective (e.g. transfer costs outweighing the points) cuts off every better solution. Solve those cold.
+    if warm_start and (pulp.value(problem.objective) or 0) > 0 and pulp.PULP_CBC_CMD(msg=0).available():
+        try:
+            problem.solve(pulp.PULP_CBC_CMD(msg=0, warmStart=True))
+            return time.perf_counter() - start
+        except (pulp.PulpSolverError, OSError) as e:
+            logger.warning('Could not warm start the solver, solving cold instead: {}'.format(e))
+    solve_cold(problem)
+    return time.perf_counter() - start
+
+
+def set_initial_squad(squad, squad_ids):
+    """
+    Warm start the squad problem from the given squad (list of player ids).
+    """
+    squad_ids = set(squad_ids)
+    for player_id, player_selected in squad['selected'].items():
+        player_selected.setInitialValue(1 if player_id in squad_ids else 0)
+    if squad['free_transfers_used'] is not None:
+        squad['free_transfers_used'].setInitialValue(0)
+
+
+def get_squad_problem(key, build):
+    """
+    Get the squad problem with the given structure, calling build() to build it the first time.
+    Returns the problem and whether it was reused.
+    """
+    with SQUAD_PROBLEMS_LOCK:
+        if key in SQUAD_PROBLEMS:
+            return SQUAD_PROBLEMS[key], True
+        SQUAD_PROBLEMS[key] = squad = build()
+        while len(SQUAD_PROBLEMS) > SQUAD_PROBLEMS_MAX_SIZE:
+            SQUAD_PROBLEMS.pop(next(iter(SQUAD_PROBLEMS)))
+        return squad, False
+
+
+def get_players_key(all_players):
+    """
+    Get everything about the players that the squad problem's constraints depend on.
+    """
+    return tuple((player['id'], player['team'], player['element_type'], player['now_cost']) for player in all_players)
+
+
+def build_squad_problem(current_squad, ignore_transfer_cost, all_players):
+    """
+    Build the variables and constraints of the squad problem, given the current squad.
+    The objective is set separately, so the problem can be re-solved when only the expected points change.
     """
     # Define the squad linear optimisation problem
     squad_prob = pulp.LpProblem('squad', pulp.LpMaximize)
 
     # Define and get some necessary constants
     teams_represented = [0] * 20
-    new_squad = []
-    new_squad_points = num_changes = num_goal = num_def = num_mid = num_att = num_cheap = num_cheap_gk = 0
+    num_changes = num_goal = num_def = num_mid = num_att = num_cheap = num_cheap_gk = 0
     current_squad_ids = [player['element']
                          for player in current_squad['picks']]
     free_transfers = max(0, current_squad['transfers']['limit'] or 0)
@@ -31,42 +135,35 @@ def select_squad(current_squad, ignore_transfer_cost):
     total_bank = squad_value + bank
 
     # Loop through every player and add them to the constraints
-    all_players = web_service.get_all_player_data()['elements']
+    selected = {}
     for player in all_players:
-        constants.PLAYERS[player['id']] = player
-        fixture_data = web_service.get_player_fixtures(player['id'])
-        player['expected_points'] = points.predict_points_multiple_gameweeks(player, fixture_data, 3)
-        expected_points_this_gameweek = points.predict_points(player, fixture_data)
-        player['expected_points_this_gameweek'] = expected_points_this_gameweek
-        player['selected'] = pulp.LpVariable(
+        selected[player['id']] = player_selected = pulp.LpVariable(
             'player_' + str(player['id']), cat='Binary')
-        teams_represented[player['team'] - 1] += player['selected']
+        teams_represented[player['team'] - 1] += player_selected
         player_type = player['element_type']
-        new_squad_points += player['selected'] * player['expected_points_this_gameweek']
         if player['now_cost'] <= 48.00:
-            num_cheap += player['selected']
+            num_cheap += player_selected
             if player_type == 1:
-                num_cheap_gk += player['selected']
-        logger.info('Predicted points for {} {}: {:.2f}'.format(player['first_name'], player['second_name'], expected_points_this_gameweek))
+                num_cheap_gk += player_selected
 
         if player_type == 1:
-            num_goal += player['selected']
+            num_goal += player_selected
         elif player_type == 2:
-            num_def += player['selected']
+            num_def += player_selected
         elif player_type == 3:
-            num_mid += player['selected']
+            num_mid += player_selected
         elif player_type == 4:
-            num_att += player['selected']
+            num_att += player_selected
 
         if player['id'] in current_squad_ids:
             index = current_squad_ids.index(player['id'])
             selling_price = current_squad['picks'][index]['selling_price']
-            bank += (1 - player['selected']) * selling_price
-            squad_value -= (1 - player['selected']) * player['now_cost']
+            bank += (1 - player_selected) * selling_price
+            squad_value -= (1 - player_selected) * player['now_cost']
         else:
-            num_changes += player['selected']
-            bank -= player['selected'] * player['now_cost']
-            squad_value += player['selected'] * player['now_cost']
+            num_changes += player_selected
+            bank -= player_selected * player['now_cost']
+            squad_value += player_selected * player['now_cost']
 
     # Account for free transfers and cost transfers
     free_transfers_used = pulp.LpVariable(
@@ -78,8 +175,7 @@ def select_squad(current_squad, ignore_transfer_cost):
     transfer_cost = ((num_changes - free_transfers_used)
                      * constants.TRANSFER_POINT_DEDUCTION) if not ignore_transfer_cost else 0
 
-    # Add problem and constraints
-    squad_prob += new_squad_points - transfer_cost
+    # Add constraints
     for team_count in teams_represented:
         squad_prob += (team_count <= constants.SQUAD_MAX_PLAYERS_SAME_TEAM)
     squad_prob += (squad_value + bank <= total_bank)
@@ -96,72 +192,99 @@ def select_squad(current_squad, ignore_transfer_cost):
     squad_prob += (num_cheap >= 4)
     squad_prob += (num_cheap_gk >= 1)
 
-    # Solve! On the pi, we need to use the GLPK solver.
-    if platform.system() == 'Linux':
-        squad_prob.solve(pulp.GLPK_CMD(msg=0))
-    else:
-        squad_prob.solve()
-
-    for player in all_players:
-        if pulp.value(player['selected']) == 1:
-            new_squad.append(player)
+    return {
+        'problem': squad_prob,
+        'selected': selected,
+        'free_transfers_used': free_transfers_used,
+        'num_changes': num_changes,
+        'transfer_cost': transfer_cost,
+        'squad_value': squad_value,
+        'bank': bank,
+        'lock': threading.Lock()
+    }
 
-    logger.info('Estimated squad points: {:.2f}'.format(pulp.value(new_squad_points)))
-    logger.info('Number of transfers: {}'.format(pulp.value(num_changes)))
-    logger.info('Cost of transfers: {}'.format(pulp.value(transfer_cost)))
-    logger.info('Team value: {}'.format(locale.currency(pulp.value(squad_value))))
-    logger.info('Bank: {}'.format(locale.currency(pulp.value(bank))))
 
-    constants.NUM_CHANGES = pulp.value(num_changes)
+def select_squad(current_squad, ignore_transfer_cost, all_players=None, warm_start=None, points_key='expected_points_this_gameweek'):
+    """
+    Given the current squad, calculate the best possible squad for next week.
+    The squad maximises points_key, e.g. expected_points for the points over the prediction horizon.
+    If all_players isn't given, the players are fetched and their points predicted first.
+    The solver is warm started from warm_start (a list of player ids, e.g. the previous run's squad),
+    or if that isn't given, the previous solution when re-solving the same problem.
+    Otherwise it's solved cold.
+    """
+    if all_players is None:
+        all_players = get_predicted_players()
+    current_squad_ids = [player['element']
+                         for player in current_squad['picks']]
+    key = ('squad', get_players_key(all_players), ignore_transfer_cost,
+           tuple((pick['element'], pick['selling_price']) for pick in current_squad['picks']),
+           current_squad['transfers']['limit'], current_squad['transfers']['value'], current_squad['transfers']['bank'])
+    squad, reused = get_squad_problem(key, lambda: build_squad_problem(current_squad, ignore_transfer_cost, all_players))
 
-    logger.debug('Current squad: {}'.format(current_squad))
-    logger.debug('New squad: {}'.format(new_squad))
+    new_squad = []
+    with squad['lock']:
+        selected = squad['selected']
+        # Only the objective changes between solves of the same problem
+        new_squad_points = pulp.lpSum(selected[player['id']] * player[points_key] for player in all_players)
+        squad['problem'].setObjective(pulp.lpSum(
+            selected[player['id']] * get_risk_adjusted_points(player, points_key) for player in all_players
+        ) - squad['transfer_cost'])
+        if warm_start is not None:
+            set_initial_squad(squad, warm_start)
+        elapsed = solve(squad['problem'], warm_start=reused or warm_start is not None)
+
+        for player in all_players:
+            if pulp.value(selected[player['id']]) == 1:
+                new_squad.append(player)
+
+        logger.info('Solved the squad in {:.2f}s ({} problem)'.format(elapsed, 'reused' if reused else 'new'))
+        logger.info('Estimated squad points: {:.2f}'.format(pulp.value(new_squad_points)))
+        logger.info('Number of transfers: {}'.format(pulp.value(squad['num_changes'])))
+        logger.info('Cost of transfers: {}'.format(pulp.value(squad['transfer_cost'])))
+        logger.info('Team value: {}'.format(format_currency(pulp.value(squad['squad_value']))))
+        logger.info('Bank: {}'.format(format_currency(pulp.value(squad['bank']))))
+
+    logger.debug('Current squad: {}'.format(current_squad_ids))
+    logger.debug('New squad: {}'.format([player['id'] for player in new_squad]))
     return new_squad
 
 
-def select_squad_ignore_transfers(bank):
+def build_squad_ignore_transfers_problem(bank, all_players):
     """
-    Ignoring the current squad, calculate the best possible squad for next week.
+    Build the variables and constraints of the squad problem, ignoring the current squad.
+    The objective is set separately, so the problem can be re-solved when only the expected points change.
     """
     # Define the squad linear optimisation problem
     squad_prob = pulp.LpProblem('squad', pulp.LpMaximize)
 
     # Define and get some necessary constants
     teams_represented = [0] * 20
-    new_squad = []
-    new_squad_points = squad_value = num_goal = num_def = num_mid = num_att = num_cheap = num_cheap_gk = 0
+    squad_value = num_goal = num_def = num_mid = num_att = num_cheap = num_cheap_gk = 0
 
     # Loop through every player and add them to the constraints
-    all_players = web_service.get_all_player_data()['elements']
+    selected = {}
     for player in all_players:
-        constants.PLAYERS[player['id']] = player
-        fixture_data = web_service.get_player_fixtures(player['id'])
-        player['expected_points'] = points.predict_points_multiple_gameweeks(player, fixture_data, 3)
-        expected_points_this_gameweek = points.predict_points(player, fixture_data)
-        player['expected_points_this_gameweek'] = expected_points_this_gameweek
-        player['selected'] = pulp.LpVariable(
+        selected[player['id']] = player_selected = pulp.LpVariable(
             'player_' + str(player['id']), cat='Binary')
-        teams_represented[player['team'] - 1] += player['selected']
+        teams_represented[player['team'] - 1] += player_selected
         player_type = player['element_type']
-        new_squad_points += player['selected'] * player['expected_points']
-        squad_value += player['selected'] * player['now_cost']
+        squad_value += player_selected * player['now_cost']
         if player['now_cost'] <= 48.00:
-            num_cheap += player['selected']
+            num_cheap += player_selected
             if player_type == 1:
-                num_cheap_gk += player['selected']
-        logger.info('Predicted points for {} {}: {:.2f}'.format(player['first_name'], player['second_name'], expected_points_this_gameweek))
+                num_cheap_gk += player_selected
 
         if player_type == 1:
-            num_goal += player['selected']
+            num_goal += player_selected
         elif player_type == 2:
-            num_def += player['selected']
+            num_def += player_selected
         elif player_type == 3:
-            num_mid += player['selected']
+            num_mid += player_selected
         elif player_type == 4:
-            num_att += player['selected']
+            num_att += player_selected
 
-    # Add problem and constraints
-    squad_prob += new_squad_points
+    # Add constraints
     for team_count in teams_represented:
         squad_prob += (team_count <= constants.SQUAD_MAX_PLAYERS_SAME_TEAM)
     squad_prob += (squad_value <= bank)
@@ -176,23 +299,83 @@ def select_squad_ignore_transfers(bank):
     squad_prob += (num_cheap >= 4)
     squad_prob += (num_cheap_gk >= 1)
 
-    # Solve! On the pi, we need to use the GLPK solver.
-    if platform.system() == 'Linux':
-        squad_prob.solve(pulp.GLPK_CMD(msg=0))
-    else:
-        squad_prob.solve()
+    return {
+        'problem': squad_prob,
+        'selected': selected,
+        'free_transfers_used': None,
+        'squad_value': squad_value,
+        'lock': threading.Lock()
+    }
 
-    for player in all_players:
-        if pulp.value(player['selected']) == 1:
-            new_squad.append(player)
 
-    logger.info('Estimated squad points: {:.2f}'.format(pulp.value(new_squad_points)))
-    logger.info('Team value: {}'.format(locale.currency(pulp.value(squad_value))))
+def select_squad_ignore_transfers(bank, all_players=None, warm_start=None):
+    """
+    Ignoring the current squad, calculate the best possible squad for next week.
+    If all_players isn't given, the players are fetched and their points predicted first.
+    The solver is warm started from warm_start (a list of player ids), or if that isn't given,
+    the previous solution when re-solving the same problem.
+    """
+    if all_players is None:
+        all_players = get_predicted_players()
+    key = ('squad_ignore_transfers', get_players_key(all_players), bank)
+    squad, reused = get_squad_problem(key, lambda: build_squad_ignore_transfers_problem(bank, all_players))
+
+    new_squad = []
+    with squad['lock']:
+        selected = squad['selected']
+        # Only the objective changes between solves of the same problem
+        new_squad_points = pulp.lpSum(selected[player['id']] * player['expected_points'] for player in all_players)
+        squad['problem'].setObjective(pulp.lpSum(
+            selected[player['id']] * get_risk_adjusted_points(player, 'expected_points') for player in all_players
+        ))
+        if warm_start is not None:
+            set_initial_squad(squad, warm_start)
+        elapsed = solve(squad['problem'], warm_start=reused or warm_start is not None)
+
+        for player in all_players:
+            if pulp.value(selected[player['id']]) == 1:
+                new_squad.append(player)
+
+        logger.info('Solved the squad in {:.2f}s ({} problem)'.format(elapsed, 'reused' if reused else 'new'))
+        logger.info('Estimated squad points: {:.2f}'.format(pulp.value(new_squad_points)))
+        logger.info('Team value: {}'.format(format_currency(pulp.value(squad['squad_value']))))
 
-    logger.debug('New squad: {}'.format(new_squad))
+    logger.debug('New squad: {}'.format([player['id'] for player in new_squad]))
     return new_squad
 
 
+def benchmark_warm_start(current_squad, all_players):
+    """
+    Log the time to the first feasible solution and to the optimal solution for a cold solve,
+    and for a solve warm started from the current squad. This needs the CBC solver,
+    as it's the only one that can be warm started and stopped at the first solution.
+    Also logs how long building the problem takes, which is skipped when it's reused.
+    """
+    if not pulp.PULP_CBC_CMD(msg=0).available():
+        logger.warning('CBC is not available, so the warm start can\'t be benchmarked')
+        return None
+    current_squad_ids = [player['element'] for player in current_squad['picks']]
+    timings = {}
+    for warm_start in (False, True):
+        for stop, options in (('first feasible', ['maxSolutions 1']), ('optimal', [])):
+            start = time.perf_counter()
+            squad = build_squad_problem(current_squad, False, all_players)
+            timings['build'] = time.perf_counter() - start
+            squad['problem'].setObjective(pulp.lpSum(
+                squad['selected'][player['id']] * get_risk_adjusted_points(player, 'expected_points_this_gameweek') for player in all_players
+            ) - squad['transfer_cost'])
+            if warm_start:
+                set_initial_squad(squad, current_squad_ids)
+            start = time.perf_counter()
+            squad['problem'].solve(pulp.PULP_CBC_CMD(msg=0, warmStart=warm_start, options=options))
+            timings[(warm_start, stop)] = time.perf_counter() - start
+    logger.info('Building the squad problem: {:.3f}s'.format(timings['build']))
+    for warm_start in (False, True):
+        logger.info('{} start: first feasible solution in {:.3f}s, optimal solution in {:.3f}s'.format(
+            'Warm' if warm_start else 'Cold', timings[(warm_start, 'first feasible')], timings[(warm_start, 'optimal')]))
+    return timings
+
+
 def select_starting(squad):
     """
     Given a squad, select the best possible starting lineup.
@@ -201,45 +384,44 @@ def select_starting(squad):
     starting_prob = pulp.LpProblem('starting_line_up', pulp.LpMaximize)
 
     # Define and get some necessary constants
-    starting_points = num_goal_starting = num_def_starting = num_mid_starting = num_att_starting = num_starting = 0
+    starting_points = risk_adjusted_points = num_goal_starting = num_def_starting = num_mid_starting = num_att_starting = num_starting = 0
     starting_lineup = {'picks': []}
 
+    starting = {}
     for player in squad:
-        player['starting'] = pulp.LpVariable(
+        starting[player['id']] = player_starting = pulp.LpVariable(
             'player_' + str(player['id']) + '_starting', cat='Binary')
         player_type = player['element_type']
-        num_starting += player['starting']
-        starting_points += player['starting'] * player['expected_points_this_gameweek']
+        num_starting += player_starting
+        starting_points += player_starting * player['expected_points_this_gameweek']
+        risk_adjusted_points += player_starting * get_risk_adjusted_points(player, 'expected_points_this_gameweek')
 
         if player_type == 1:
-            num_goal_starting += player['starting']
+            num_goal_starting += player_starting
         elif player_type == 2:
-            num_def_starting += player['starting']
+            num_def_starting += player_starting
         elif player_type == 3:
-            num_mid_starting += player['starting']
+            num_mid_starting += player_starting
         elif player_type == 4:
-            num_att_starting += player['starting']
+            num_att_starting += player_starting
 
     # Add problem and constraints
-    starting_prob += starting_points
+    starting_prob += risk_adjusted_points
     starting_prob += (num_goal_starting == constants.STARTING_MIN_GOALKEEPERS)
     starting_prob += (num_def_starting >= constants.STARTING_MIN_DEFENDERS)
     starting_prob += (num_mid_starting >= constants.STARTING_MIN_MIDFIELDERS)
     starting_prob += (num_att_starting >= constants.STARTING_MIN_ATTACKERS)
     starting_prob += (num_starting == constants.STARTING_SIZE)
 
-    # Solve! On the pi, we need to use the GLPK solver.
-    if platform.system() == 'Linux':
-        starting_prob.solve(pulp.GLPK_CMD(msg=0))
-    else:
-        starting_prob.solve()
+    # Solve!
+    solve(starting_prob)
     logger.info('Estimated starting points: {:.2f}'.format(pulp.value(starting_points)))
 
     # Split the squad into starting lineup and subs
     starting_list = [player for player in squad if pulp.value(
-        player['starting']) == 1]
+        starting[player['id']]) == 1]
     subs_list = [player for player in squad if pulp.value(
-        player['starting']) == 0]
+        starting[player['id']]) == 0]
 
     # First sort the starting lineup by expected points to give us the captain
     # and vice captain
@@ -268,7 +450,7 @@ def select_starting(squad):
             marker='V'
         logger.info('{} {}  {}  {}  {:.2f}  {:.2f}'.format(
             marker,
-            locale.currency(player['now_cost']),
+            format_currency(player['now_cost']),
             player['first_name'],
             player['second_name'],
             player['expected_points_this_gameweek'],
@@ -283,7 +465,7 @@ def select_starting(squad):
     for player in subs_list:
         logger.info('{} {}  {}  {}  {:.2f}  {:.2f}'.format(
             '-',
-            locale.currency(player['now_cost']),
+            format_currency(player['now_cost']),
             player['first_name'],
             player['second_name'],
             player['expected_points_this_gameweek'],
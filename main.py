@@ -1,22 +1,28 @@
 """
-The main program.
-    1. Log in to fantasy.premierleague.com.
-    2. Get the current squad.
-    3. Calculate the best squad possible for next week.
-    4. Update the squad on fantasy.premierleague.com.
-    5. Calculate the best possible starting lineup for next week.
-    6. Update the starting lineup on fantasy.premierleague.com.
+The main program, split into subcommands:
+    deadline: check whether the next transfer deadline is today.
+    train: train a new model and save it.
+    predict: predict every player's points.
+    solve: calculate the best squad and starting lineup for next week, and optionally apply them.
+        With --from-snapshot, solve from a previous run's snapshot without the network or the model.
+        1. Log in to fantasy.premierleague.com.
+        2. Get the current squad.
+        3. Calculate the best squad possible for next week.
+        4. Update the squad on fantasy.premierleague.com.
+        5. Calculate the best possible starting lineup for next week.
+        6. Update the starting lineup on fantasy.premierleague.com.
+    apply: the same as solve, but apply the changes without asking.
+Each subcommand only imports the modules it needs, as importing the neural network
+(torch, pandas and the dataset) and the solver (pulp) takes a while.
 """
 import argparse
 import codecs
 import constants
-import linear_solver
 import logging
-import neural_network
+import os
 import sys
-import web_service
-import getpass
 import datetime
+import time
 
 logLevels = {
     'debug': logging.DEBUG,
@@ -26,98 +32,332 @@ logLevels = {
 
 # Set up the command line parser
 parser = argparse.ArgumentParser(description='Mr Robot v3.0')
-parser.add_argument('username', help='Login username for fantasy.premierleague.com')
-parser.add_argument('--password', help='Login password for fantasy.premierleague.com')
-parser.add_argument('--apply', action='store_true', help='Whether to apply the changes (default: False)')
-parser.add_argument('--check-deadline', action='store_true', help='Check the deadline is the same day before running the script (default: False)')
-parser.add_argument('--wildcard', action='store_true', help='Use to ignore transfer costs when calculating the new lineup (default: False)')
-parser.add_argument('--ignore-squad', action='store_true', help='Whether to ignore the current squad when calculating the new squad (default: False)')
-parser.add_argument('--update-model', action='store_true', help='Whether to recalculate the model or use the stored one. Note: this can take a long time! (default: False)')
 parser.add_argument('--log-level', choices=list(logLevels.keys()), help='Set the logging level (default: "info")', default='info')
-parser.add_argument('--budget', type=int, help='Set the budget', default=1000)
-
-args = parser.parse_args()
-
-if not args.password:
-    args.password = getpass.getpass(prompt='Password for {}: '.format(constants.LOGIN_URL))
-
-# Set up the logger
-# Log info to stdout, debug to file
-fileHandler = logging.FileHandler('./.debug.log', 'w')
-fileHandler.setLevel(logging.DEBUG)
-consoleHandler = logging.StreamHandler(sys.stdout)
-consoleHandler.setLevel(logLevels[args.log_level])
-logging.basicConfig(
-    handlers=[
-        consoleHandler,
-        fileHandler
-    ],
-    level=logging.DEBUG,
-    format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
-)
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+subparsers.add_parser('deadline', help='Check whether the next transfer deadline is today. Exits with status 1 if it isn\'t')
+
+train_parser = subparsers.add_parser('train', help='Train a new model and save it. Note: this can take a long time!')
+train_parser.add_argument('--train-workers', type=int, help='Number of processes to train the model with (default: 1)', default=1)
+train_parser.add_argument('--train-threads', type=int, help='Number of threads for each training process (default: 1)', default=1)
+train_parser.add_argument('--horizon', type=int, help='Train a multi-horizon model that predicts this many fixtures in one forward pass (default: 1)', default=1)
+train_parser.add_argument('--benchmark-training', action='store_true', help='Log the training scaling efficiency from 1 to --train-workers processes before training (default: False)')
+
+predict_parser = subparsers.add_parser('predict', help='Predict every player\'s points with the stored model')
+predict_parser.add_argument('--top', type=int, help='Number of players to list, best first (default: 20)', default=20)
+
+# solve and apply take the same arguments
+solve_arguments = argparse.ArgumentParser(add_help=False)
+solve_arguments.add_argument('--password', help='Login password for fantasy.premierleague.com, for every username without its own. Only needed when there is no valid cached login (default: prompt when needed)')
+solve_arguments.add_argument('--record-video', action='store_true', help='Record a video of the browser login under ./playwright_videos (default: False)')
+solve_arguments.add_argument('--check-deadline', action='store_true', help='Check the deadline is the same day before running the script (default: False)')
+solve_arguments.add_argument('--wildcard', action='store_true', help='Use to ignore transfer costs when calculating the new lineup (default: False)')
+solve_arguments.add_argument('--ignore-squad', action='store_true', help='Whether to ignore the current squad when calculating the new squad (default: False)')
+solve_arguments.add_argument('--budget', type=int, help='Set the budget', default=1000)
+solve_arguments.add_argument('--plan-chips', action='store_true', help='Evaluate the available chips and play the recommended one, instead of only playing the wildcard for 6+ transfers (default: False)')
+solve_arguments.add_argument('--risk-aversion', type=float, help='Penalise each player\'s expected points by this many times the variance of the prediction, to prefer more certain players (default: 0)', default=0)
+solve_arguments.add_argument('--benchmark-solver', action='store_true', help='Log the time to the first feasible and the optimal squad, solving from scratch and warm started from the current squad (default: False)')
+solve_arguments.add_argument('--daemon', action='store_true', help='Keep running, prefetching the data before each deadline and making the final solve just before it (default: False)')
+solve_arguments.add_argument('--prefetch-lead', type=int, help='In daemon mode, how many minutes before the deadline to prefetch the data (default: {})'.format(constants.DAEMON_PREFETCH_LEAD // 60), default=constants.DAEMON_PREFETCH_LEAD // 60)
+solve_arguments.add_argument('--final-lead', type=int, help='In daemon mode, how many minutes before the deadline to make the final solve (default: {})'.format(constants.DAEMON_FINAL_LEAD // 60), default=constants.DAEMON_FINAL_LEAD // 60)
+solve_parser = subparsers.add_parser('solve', parents=[solve_arguments], help='Calculate the new squad and starting lineup, and ask whether to apply them')
+solve_parser.add_argument('username', nargs='*', help='Login username for fantasy.premierleague.com, or username:ENVVAR to read its password from the environment variable ENVVAR. Give more than one to manage several entries from one data fetch. With --from-snapshot, only solve these entries (default: every entry in the snapshot)')
+solve_parser.add_argument('--from-snapshot', help='Solve from a snapshot directory saved by a previous run ("latest" for the most recent) instead of fetching the data and predicting the points. The changes can\'t be applied')
+apply_parser = subparsers.add_parser('apply', parents=[solve_arguments], help='Calculate the new squad and starting lineup, and apply them')
+apply_parser.add_argument('username', nargs='+', help='Login username for fantasy.premierleague.com, or username:ENVVAR to read its password from the environment variable ENVVAR. Give more than one to manage several entries from one data fetch')
+apply_parser.set_defaults(from_snapshot=None)
+
+# The parsed arguments, set when main.py is run directly
+args = None
 logger = logging.getLogger()
 
-# Use a StreamWriter to output in UTF-8 else some of the logs can cause errors
-# This may result in some characters not rendering correctly in Windows cmd window
-# http://stackoverflow.com/questions/16346914/python-3-2-unicodeencodeerror-charmap-codec-cant-encode-character-u2013-i
-if sys.stdout.encoding != 'UTF-8':
-    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
-if sys.stderr.encoding != 'UTF-8':
-    sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+# The entries logged in to by solve/apply
+ENTRIES = []
 
-# Login
-logger.info('Logging in to {}'.format(constants.LOGIN_URL))
-web_service.login(args.username, args.password)
 
-if args.check_deadline:
-    # Check deadline is today
+def is_deadline_today():
+    """
+    Check whether the next transfer deadline is today.
+    """
+    import web_service
     logger.info('Checking the deadline')
     today = datetime.datetime.now().strftime('%Y-%m-%d')
     logger.debug('Today is {}'.format(today))
-    deadline = web_service.get_deadline_date()
-    if not deadline == today:
-        logger.info('Deadline is not today, exiting')
-        sys.exit()
-    else:
-        logger.info('Deadline is today, continuing')
+    return web_service.get_deadline_date() == today
+
 
-# Initialise the neural network
-logger.info('Initialising the neural network')
-if args.update_model:
+def train():
+    """
+    Train a new model, test it and save it.
+    """
+    import neural_network
     logger.info('Updating the model')
-    neural_network.train_model()
+    if args.horizon > 1:
+        neural_network.use_model(dict(neural_network.model_config, horizon=args.horizon))
+    if args.benchmark_training:
+        neural_network.benchmark_training(args.train_workers, args.train_threads)
+    if args.train_workers > 1:
+        neural_network.train_model_distributed(args.train_workers, args.train_threads)
+    else:
+        neural_network.train_model()
     neural_network.test_model()
     neural_network.save_model()
-else:
+
+
+def predict():
+    """
+    Predict every player's points, and log the best players.
+    """
+    import change_detection
+    import neural_network
+    import points
+    import run_snapshot
+    import web_service
     logger.info('Loading model')
     neural_network.load_model()
+    static_data = web_service.get_all_player_data()
+    if web_service.update_next_event(static_data) is None:
+        sys.exit(1)
+    all_players = change_detection.predict_changed_players(points.reduce_players(static_data))
+    run_snapshot.save_snapshot(all_players)
+    for player in sorted(all_players, key=lambda player: player['expected_points'], reverse=True)[:args.top]:
+        logger.info('{} {}: {:.2f} (variance {:.2f}) this gameweek, {:.2f} (variance {:.2f}) over {} gameweeks'.format(
+            player['first_name'], player['second_name'], player['expected_points_this_gameweek'], player['expected_points_this_gameweek_variance'],
+            player['expected_points'], player['expected_points_variance'], constants.PREDICTION_HORIZON))
+
+
+def calculate_entry_changes(entry, all_players, current_squad=None):
+    """
+    Calculate the new squad and starting lineup for one entry.
+    The current squad is fetched unless it's given (e.g. from a snapshot).
+    """
+    import chip_planner
+    import linear_solver
+    import run_snapshot
+    import web_service
+    # Get the current squad
+    if args.ignore_squad:
+        current_squad = None
+    elif current_squad is None:
+        logger.info('Retrieving the current squad for {}'.format(entry['username']))
+        current_squad = web_service.get_transfers_squad(entry)
+
+    if args.plan_chips and current_squad is not None:
+        # Solve every chip scenario and use the recommended one
+        logger.info('Planning the chips for {}'.format(entry['username']))
+        plan = chip_planner.plan_chips(current_squad, all_players)
+        chip, new_squad, new_starting = plan['chip'], plan['squad'], plan['starting']
+        if chip in ('bboost', '3xc'):
+            new_starting['chip'] = chip
+        return entry, current_squad, new_squad, new_starting, chip
+
+    if args.benchmark_solver and current_squad is not None:
+        linear_solver.benchmark_warm_start(current_squad, all_players)
+
+    # Calculate the new squad, starting from the previous run's squad
+    logger.info('Calculating the new squad for {}'.format(entry['username']))
+    previous_squad = run_snapshot.load_previous_squad(entry.get('id'))
+    if args.ignore_squad:
+        new_squad = linear_solver.select_squad_ignore_transfers(args.budget, all_players, previous_squad)
+    else:
+        new_squad = linear_solver.select_squad(current_squad, args.wildcard, all_players, previous_squad)
+
+    # Calculate the new starting lineup
+    logger.info('Calculating the new starting lineup for {}'.format(entry['username']))
+    new_starting = linear_solver.select_starting(new_squad)
+    return entry, current_squad, new_squad, new_starting, None
+
+
+def calculate_changes(all_players=None):
+    """
+    Calculate the new squad and starting lineup for every entry.
+    The players are fetched and predicted once (unless all_players is given),
+    then each entry is solved concurrently (or in turn when planning chips).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import linear_solver
+    import run_snapshot
+    if all_players is None:
+        all_players = linear_solver.get_predicted_players()
+    if args.plan_chips:
+        # The chip planner forks worker processes, which can deadlock if other threads hold locks,
+        # so solve the entries one at a time from the main thread (each plan is still parallel)
+        changes = [calculate_entry_changes(entry, all_players) for entry in ENTRIES]
+    else:
+        with ThreadPoolExecutor(max_workers=len(ENTRIES)) as executor:
+            changes = list(executor.map(lambda entry: calculate_entry_changes(entry, all_players), ENTRIES))
+    run_snapshot.save_snapshot(all_players, changes)
+    return changes
+
+
+def solve_from_snapshot():
+    """
+    Solve the entries in a snapshot from their saved players and current squads,
+    without the network or the model.
+    """
+    import run_snapshot
+    path = run_snapshot.get_latest_snapshot() if args.from_snapshot == 'latest' else args.from_snapshot
+    if path is None:
+        logger.error('No snapshots found in {}'.format(constants.RUN_SNAPSHOT_DIR))
+        sys.exit(1)
+    snapshot = run_snapshot.load_snapshot(path)
+    if snapshot is None:
+        sys.exit(1)
+    all_players, entries = snapshot
+    if not entries and args.ignore_squad:
+        # the snapshot only has the predictions (e.g. from predict), which is enough to pick a new squad
+        entries = [({'id': None, 'username': 'snapshot'}, None)]
+    start = time.perf_counter()
+    for entry, current_squad in entries:
+        if args.username and entry['username'] not in [username.split(':', 1)[0] for username in args.username]:
+            continue
+        if current_squad is None and not args.ignore_squad:
+            logger.error('The snapshot has no current squad for {}, use --ignore-squad to solve without one'.format(entry['username']))
+            continue
+        calculate_entry_changes(entry, all_players, current_squad)
+    logger.info('Solved from the snapshot in {:.2f}s'.format(time.perf_counter() - start))
+
+
+def apply_changes(changes):
+    """
+    Update each entry's squad and starting lineup on fantasy.premierleague.com.
+    """
+    import chip_planner
+    import web_service
+    for entry, current_squad, new_squad, new_starting, chip in changes:
+        # make transfers to update the squad on fantasy.premierleague.com
+        logger.info('Applying the transfers for {}'.format(entry['username']))
+        if not args.plan_chips:
+            current_squad_ids = [player['element'] for player in current_squad['picks']]
+            num_changes = len([player for player in new_squad if player['id'] not in current_squad_ids])
+            wildcard_status = (next(x for x in current_squad['chips'] if x['name'] == 'wildcard'))['status_for_entry'] == 'available'
+            chip = 'wildcard' if args.wildcard or ((num_changes >= 6) and wildcard_status) else None
+        transfer_object = web_service.create_transfers_object(
+            current_squad['picks'], new_squad, chip if chip in chip_planner.SQUAD_CHIPS else None, entry)
+        if web_service.make_transfers(transfer_object, entry, current_squad) is None:
+            # the starting lineup is picked from the new squad, so it can't be set without the transfers
+            logger.error('Not updating the starting lineup for {} as the transfers failed'.format(entry['username']))
+            continue
+
+        # update the starting lineup on fantasy.premierleague.com
+        logger.info('Updating the starting lineup for {}'.format(entry['username']))
+        web_service.set_starting_lineup(new_starting, entry, [player['id'] for player in new_squad])
+
+
+def get_credentials(username):
+    """
+    Split a username argument into the username and its password (None to prompt when needed).
+    username:ENVVAR reads the password from the environment variable ENVVAR, otherwise --password is used.
+    """
+    if ':' not in username:
+        return username, args.password
+    username, password_variable = username.split(':', 1)
+    password = os.environ.get(password_variable)
+    if password is None:
+        logger.error('Environment variable {} with the password for {} is not set'.format(password_variable, username))
+    return username, password
+
+
+def solve(apply):
+    """
+    Log in to every entry, calculate the changes and apply them (asking first unless apply is set).
+    """
+    constants.RISK_AVERSION = args.risk_aversion
+    if args.from_snapshot:
+        solve_from_snapshot()
+        return
+    import web_service
+    # The deadline doesn't need a login, so check it first
+    if args.check_deadline and not args.daemon:
+        if not is_deadline_today():
+            logger.info('Deadline is not today, exiting')
+            return
+        logger.info('Deadline is today, continuing')
+
+    credentials = [get_credentials(username) for username in args.username]
+    if args.daemon and not all(password for username, password in credentials):
+        # the daemon can't prompt for a password when a login expires
+        logger.error('Daemon mode needs a password for every username (username:ENVVAR or --password)')
+        sys.exit(1)
+
+    # Login to every entry, each with its own session
+    logger.info('Logging in to {}'.format(constants.LOGIN_URL))
+    for username, password in credentials:
+        entry = web_service.MY_ENTRY if len(ENTRIES) == 0 else web_service.new_entry()
+        ENTRIES.append(web_service.login(username, password, args.record_video, entry))
+    if constants.NEXT_EVENT is None and not args.daemon:
+        # there's nothing to solve for until next season
+        return
+
+    # Initialise the neural network
+    logger.info('Initialising the neural network')
+    import neural_network
+    logger.info('Loading model')
+    neural_network.load_model()
+
+    if args.daemon:
+        import scheduler
+        logger.info('Running in daemon mode')
+        scheduler.run(
+            calculate_changes,
+            apply_changes if apply else None,
+            prefetch_lead=args.prefetch_lead * 60,
+            final_lead=args.final_lead * 60
+        )
+    else:
+        changes = calculate_changes()
+        if apply or input('Apply these changes? (y/n): ').lower().strip() == 'y':
+            apply_changes(changes)
+        else:
+            logger.info('Changes not applied')
+
+
+# Only run the subcommand when main.py is run directly, not when a worker process
+# started with spawn (e.g. on macOS or Windows) imports it
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'solve' and not args.username and not args.from_snapshot:
+        parser.error('solve needs at least one username, or --from-snapshot')
+
+    # Set up the logger
+    # Log info to stdout, debug to file
+    fileHandler = logging.FileHandler('./.debug.log', 'w')
+    fileHandler.setLevel(logging.DEBUG)
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setLevel(logLevels[args.log_level])
+    logging.basicConfig(
+        handlers=[
+            consoleHandler,
+            fileHandler
+        ],
+        level=logging.DEBUG,
+        format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+    )
+    # Use a StreamWriter to output in UTF-8 else some of the logs can cause errors
+    # This may result in some characters not rendering correctly in Windows cmd window
+    # http://stackoverflow.com/questions/16346914/python-3-2-unicodeencodeerror-charmap-codec-cant-encode-character-u2013-i
+    if sys.stdout.encoding != 'UTF-8':
+        sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+    if sys.stderr.encoding != 'UTF-8':
+        sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+
+    if args.command == 'deadline':
+        if is_deadline_today():
+            logger.info('Deadline is today')
+        else:
+            logger.info('Deadline is not today')
+            sys.exit(1)
+    elif args.command == 'train':
+        train()
+    elif args.command == 'predict':
+        predict()
+    else:
+        solve(args.command == 'apply')
 
-# Get the current squad
-if not args.ignore_squad:
-    logger.info('Retrieving the current squad')
-    CURRENT_SQUAD = web_service.get_transfers_squad()
-
-# Calculate the new squad
-logger.info('Calculating the new squad')
-if args.ignore_squad:
-    NEW_SQUAD = linear_solver.select_squad_ignore_transfers(args.budget)
-else:
-    NEW_SQUAD = linear_solver.select_squad(CURRENT_SQUAD, args.wildcard)
-
-# Calculate the new starting lineup
-logger.info('Calculating the new starting lineup')
-NEW_STARTING = linear_solver.select_starting(NEW_SQUAD)
-
-if args.apply or input('Apply these changes? (y/n): ').lower().strip() == 'y':
-    # make transfers to update the squad on fantasy.premierleague.com
-    logger.info('Applying the transfers')
-    WILDCARD_STATUS = (next(x for x in CURRENT_SQUAD['chips'] if x['name'] == 'wildcard'))['status_for_entry'] == 'available'
-    TRANSFER_OBJECT = web_service.create_transfers_object(
-        CURRENT_SQUAD['picks'], NEW_SQUAD, args.wildcard or ((constants.NUM_CHANGES >= 6) and WILDCARD_STATUS))
-    web_service.make_transfers(TRANSFER_OBJECT)
-
-    # update the starting lineup on fantasy.premierleague.com
-    logger.info('Updating the starting lineup')
-    web_service.set_starting_lineup(NEW_STARTING)
-else:
-    logger.info('Changes not applied')
+    try:
+        import resource
+        # ru_maxrss is in kilobytes on Linux
+        logger.info('Peak memory usage: {:.0f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    except ImportError:
+        # resource isn't available on Windows
+        pass
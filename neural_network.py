@@ -1,40 +1,67 @@
 """
 Create a neural network to analyse the previous data and predict points using PyTorch
 """
-from dateutil import parser
 from numpy import random, sqrt, stack
-from pandas import read_csv
+from pandas import DataFrame, Timestamp, concat, read_csv, to_datetime
 from torch.utils.data import random_split
 from torch.nn import BatchNorm1d, Dropout, Embedding, Linear, Module, ModuleList, MSELoss, ReLU, Sequential
-from torch.optim import SGD
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import SGD, Adam
 from constants import DEFAULT_MODEL_PATH
+import hashlib
 import logging
 import os
+import socket
+import tempfile
+import time
 import torch
+import torch.distributed
+import torch.multiprocessing
 import constants
 
 logger = logging.getLogger()
 
+# The model architecture and training settings.
+# This is saved with the model, so load_model can rebuild the same architecture.
+DEFAULT_MODEL_CONFIG = {
+    'layer_sizes': [100, 50, 25],
+    'dropout': 0.2,
+    'embedding_dropout': 0.1,
+    'max_embedding_size': 50,
+    'optimizer': 'SGD',
+    'lr': 0.001,
+    'momentum': 0.9,
+    'epochs': 5000,
+    'numerical_columns': ['days_since_season_start', 'kickoff_hour', 'round', 'value', 'GW'],
+    # number of fixtures predicted per forward pass, more than 1 uses the multi-horizon model
+    'horizon': 1
+}
+# Models saved before the kickoff time features were added used the raw epoch timestamp
+LEGACY_NUMERICAL_COLUMNS = ['kickoff_timestamp', 'round', 'value', 'GW']
+# The multi-horizon model takes the player's columns once, and these columns for every fixture
+PLAYER_COLUMNS = ['name', 'position', 'season_x']
+FIXTURE_COLUMNS = ['opp_team_name', 'was_home']
+
 class Model(Module):
-    def __init__(self, embedding_size, num_numerical_cols):
+    def __init__(self, embedding_size, num_numerical_cols, layer_sizes=DEFAULT_MODEL_CONFIG['layer_sizes'],
+                 dropout=DEFAULT_MODEL_CONFIG['dropout'], embedding_dropout=DEFAULT_MODEL_CONFIG['embedding_dropout'], num_outputs=1):
         super().__init__()
         self.all_embeddings = ModuleList([Embedding(ni, nf) for ni, nf in embedding_size])
-        self.embedding_dropout = Dropout(0.1)
+        self.embedding_dropout = Dropout(embedding_dropout)
         self.batch_norm_num = BatchNorm1d(num_numerical_cols)
 
         all_layers = []
         num_categorical_cols = sum((nf for ni, nf in embedding_size))
         layer_size = num_categorical_cols + num_numerical_cols
 
-        layer_sizes = [100, 50, 25]
         for i, new_layer_size in enumerate(layer_sizes):
             all_layers.append(Linear(layer_size, new_layer_size))
             all_layers.append(ReLU(inplace=True))
             all_layers.append(BatchNorm1d(new_layer_size))
-            all_layers.append(Dropout(0.2))
+            all_layers.append(Dropout(dropout))
             layer_size = new_layer_size
 
-        all_layers.append(Linear(layer_sizes[-1], 1))
+        all_layers.append(Linear(layer_sizes[-1], num_outputs))
         self.layers = Sequential(*all_layers)
 
     def forward(self, x_categorical, x_numerical):
@@ -48,6 +75,41 @@ class Model(Module):
         x = self.layers(x)
         return x
 
+def add_features(frame):
+    """
+    Derive the numerical features from the kickoff time. This is vectorised over the whole frame,
+    and used for both the training data and the data we predict from.
+        - days_since_season_start: days since 1st August of the season
+        - kickoff_hour: time of day of the kickoff (UTC), in hours
+        - kickoff_timestamp: epoch timestamp (only used by older models)
+    """
+    kickoff = to_datetime(frame['kickoff_time'], utc=True, format='ISO8601')
+    season_start = to_datetime(frame['season_x'].astype(str).str[:4] + '-08-01', utc=True, format='%Y-%m-%d')
+    frame['kickoff_timestamp'] = (kickoff - Timestamp(0, tz='UTC')).dt.total_seconds()
+    frame['days_since_season_start'] = (kickoff - season_start).dt.total_seconds() / (24 * 60 * 60)
+    frame['kickoff_hour'] = kickoff.dt.hour + kickoff.dt.minute / 60
+    return frame
+
+def get_numerical_columns(config):
+    """
+    Get the numerical columns the config's model takes. The multi-horizon model takes them for
+    every fixture in the horizon, suffixed with the fixture's offset e.g. kickoff_hour_1.
+    """
+    if config['horizon'] == 1:
+        return config['numerical_columns']
+    return ['{}_{}'.format(col, offset) for offset in range(config['horizon']) for col in config['numerical_columns']]
+
+def get_numerical_data(frame, config):
+    """
+    Get the numerical features the config's model uses as a tensor, normalised with the
+    training data's means and standard deviations if the config has them.
+    """
+    data = stack([frame[col].values.astype(float) for col in get_numerical_columns(config)], 1)
+    if 'numerical_means' in config:
+        # the multi-horizon model has the same columns for every fixture
+        data = (data - config['numerical_means'] * config['horizon']) / (config['numerical_stds'] * config['horizon'])
+    return torch.tensor(data, dtype=torch.float)
+
 # prepare and load the data
 path = './data/cleaned_merged_seasons.csv'
 df = read_csv(path, index_col=False, dtype={
@@ -90,13 +152,15 @@ df = read_csv(path, index_col=False, dtype={
     'GW': int
 })
 # remove all values without any minutes played
-df = df[df['minutes'] > 0]
-# convert kickoff times to epoch timestamps
-df['kickoff_time'] = df['kickoff_time'].apply(lambda x: parser.isoparse(x).timestamp())
+df = df[df['minutes'] > 0].copy()
+# derive the numerical features
+preprocessing_start = time.perf_counter()
+df = add_features(df)
+logger.debug('Preprocessed {} rows in {:.3f}s'.format(len(df), time.perf_counter() - preprocessing_start))
 
 # define the columns we're interested in
 categorical_columns = ['name', 'opp_team_name', 'position', 'season_x', 'was_home']
-numerical_columns = ['kickoff_time', 'round', 'value', 'GW']
+numerical_columns = DEFAULT_MODEL_CONFIG['numerical_columns']
 outputs = ['total_points']
 
 # set categorical columns to have type=category
@@ -111,27 +175,107 @@ for column in categorical_columns:
         categorical_column_sizes.append(len(df[column].cat.categories) + 1)
     else:
         categorical_column_sizes.append(len(df[column].cat.categories))
-categorical_embedding_sizes = [(col_size, min(50, (col_size+1)//2)) for col_size in categorical_column_sizes]
+
+def get_embedding_sizes(max_embedding_size, horizon=1):
+    column_sizes = dict(zip(categorical_columns, categorical_column_sizes))
+    columns = categorical_columns if horizon == 1 else PLAYER_COLUMNS + FIXTURE_COLUMNS * horizon
+    return [(column_sizes[col], min(max_embedding_size, (column_sizes[col]+1)//2)) for col in columns]
+
+def get_categorical_columns(config):
+    """
+    Get the categorical columns the config's model takes, in the same order as get_embedding_sizes.
+    """
+    if config['horizon'] == 1:
+        return categorical_columns
+    return ['{}_0'.format(col) for col in PLAYER_COLUMNS] + ['{}_{}'.format(col, offset) for offset in range(config['horizon']) for col in FIXTURE_COLUMNS]
 
 # split the data 80/20 into training and test data
 msk = random.rand(len(df)) < 0.8
 training_data = df[msk]
 test_data = df[~msk]
 
+# the model config also holds the normalisation for the numerical features
+model_config = dict(
+    DEFAULT_MODEL_CONFIG,
+    numerical_means=training_data[numerical_columns].mean().tolist(),
+    numerical_stds=training_data[numerical_columns].std().replace(0, 1).fillna(1).tolist()
+)
+
 # convert data into tensors of the correct format
 categorical_training_data = stack([training_data[col].cat.codes.values for col in categorical_columns], 1)
 categorical_training_data = torch.tensor(categorical_training_data, dtype=torch.int64)
 categorical_test_data = stack([test_data[col].cat.codes.values for col in categorical_columns], 1)
 categorical_test_data = torch.tensor(categorical_test_data, dtype=torch.int64)
-numerical_training_data = stack([training_data[col].values for col in numerical_columns], 1)
-numerical_training_data = torch.tensor(numerical_training_data, dtype=torch.float)
-numerical_test_data = stack([test_data[col].values for col in numerical_columns], 1)
-numerical_test_data = torch.tensor(numerical_test_data, dtype=torch.float)
+numerical_training_data = get_numerical_data(training_data, model_config)
+numerical_test_data = get_numerical_data(test_data, model_config)
 training_outputs = torch.tensor(training_data[outputs].values, dtype=torch.float).flatten()
 test_outputs = torch.tensor(test_data[outputs].values, dtype=torch.float).flatten()
 
+# Training and test data for the multi-horizon model, for each horizon, built when first needed
+SEQUENCE_DATA = {}
+
+def get_sequences(frame, horizon):
+    """
+    Turn each row into the sequence of the player's next horizon fixtures in the same season,
+    with the points scored in each as the targets. The columns for each fixture are suffixed with
+    its offset, e.g. total_points_1 is the points scored in the following fixture.
+    This is a shift within each player's season, so it's vectorised rather than per player and week.
+    Rows without horizon fixtures left in the season are dropped.
+    """
+    frame = frame.sort_values('kickoff_timestamp')
+    groups = frame.groupby(['name', 'season_x'], observed=True)
+    columns = categorical_columns + numerical_columns + outputs
+    return concat([groups[columns].shift(-offset).add_suffix('_{}'.format(offset)) for offset in range(horizon)], axis=1).dropna()
+
+def get_sequence_data(horizon):
+    """
+    Get the training and test sequences for the multi-horizon model, split 80/20 by each player's season.
+    A sequence's targets are the player's later fixtures in the same season, so splitting by the first
+    fixture (like the single fixture data) would train on fixtures that are targets in the test data.
+    """
+    if horizon not in SEQUENCE_DATA:
+        start = time.perf_counter()
+        sequences = get_sequences(df, horizon)
+        groups = df.groupby(['name', 'season_x'], observed=True).ngroup()
+        in_training_group = random.rand(groups.max() + 1) < 0.8
+        in_training = in_training_group[groups.loc[sequences.index].values]
+        SEQUENCE_DATA[horizon] = (sequences[in_training], sequences[~in_training])
+        logger.debug('Built {} sequences of {} fixtures in {:.3f}s'.format(len(sequences), horizon, time.perf_counter() - start))
+    return SEQUENCE_DATA[horizon]
+
+def get_data(config, test=False):
+    """
+    Get the categorical inputs, numerical inputs and outputs of the training (or test) data
+    for the config's model, as tensors.
+    """
+    if config['horizon'] == 1:
+        if test:
+            return categorical_test_data, get_numerical_data(test_data, config), test_outputs
+        return categorical_training_data, get_numerical_data(training_data, config), training_outputs
+    frame = get_sequence_data(config['horizon'])[1 if test else 0]
+    categorical_data = stack([frame[col].cat.codes.values for col in get_categorical_columns(config)], 1)
+    output_columns = ['{}_{}'.format(col, offset) for offset in range(config['horizon']) for col in outputs]
+    return (
+        torch.tensor(categorical_data, dtype=torch.int64),
+        get_numerical_data(frame, config),
+        torch.tensor(frame[output_columns].values, dtype=torch.float)
+    )
+
+def create_model(config):
+    """
+    Create a new model with the architecture from the given config.
+    """
+    return Model(
+        get_embedding_sizes(config['max_embedding_size'], config['horizon']),
+        len(get_numerical_columns(config)),
+        layer_sizes=config['layer_sizes'],
+        dropout=config['dropout'],
+        embedding_dropout=config['embedding_dropout'],
+        num_outputs=config['horizon']
+    )
+
 # define the neural network model
-model = Model(categorical_embedding_sizes, len(numerical_columns))
+model = create_model(model_config)
 
 def get_player(player_name):
     name_dict = dict(enumerate(df['name'].cat.categories))
@@ -179,56 +323,297 @@ def get_season_id(season):
     # handle the case where the new season id is not in the data
     return season_id if season_id is not None else len(season_dict)
 
-# train the model
-def train_model():
-    logger.info('Training the model. This could take a long time...')
-    model.train()
+def train(network, config, categorical_data, numerical_data, training_outputs, epochs=None, on_epoch=None, log=True):
+    """
+    Train the given network with the optimiser settings from the config.
+    on_epoch(epoch, loss) is called after each epoch, and training stops early if it returns False.
+    """
+    epochs = epochs or config['epochs']
+    network.train()
     # define the optimization
     loss_function = MSELoss()
-    optimizer = SGD(model.parameters(), lr=0.001, momentum=0.9)
-    epochs = 5000
+    if config['optimizer'] == 'Adam':
+        optimizer = Adam(network.parameters(), lr=config['lr'])
+    else:
+        optimizer = SGD(network.parameters(), lr=config['lr'], momentum=config['momentum'])
     # enumerate epochs
     for epoch in range(epochs):
         # compute the model output
-        predictions = model(categorical_training_data, numerical_training_data).squeeze()
+        predictions = network(categorical_data, numerical_data).squeeze()
         # calculate loss compared to actual outputs
         loss = loss_function(predictions, training_outputs)
-        logger.info('Epoch: {}/{}. Loss: {:.2f}'.format(epoch+1, epochs, loss))
+        if log:
+            logger.info('Epoch: {}/{}. Loss: {:.2f}'.format(epoch+1, epochs, loss))
         # clear the gradients
         optimizer.zero_grad()
         # credit assignment
         loss.backward()
         # update model weights
         optimizer.step()
+        if on_epoch is not None and on_epoch(epoch, loss.item()) is False:
+            break
+
+# train the model
+def train_model(epochs=None):
+    logger.info('Training the model. This could take a long time...')
+    train(model, model_config, *get_data(model_config), epochs)
+
+def train_worker(rank, num_workers, num_threads, epochs, port, state_path, config, state_dict, data):
+    """
+    Train one shard of the training data as part of a data parallel training run.
+    The gradients are averaged across every worker, so each epoch is equivalent to a full batch step.
+    The model config, starting weights and training data come from the parent, as a spawned worker
+    re-imports this module and would otherwise draw a different train/test split.
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=num_workers)
+    # pin each worker to its own cores so they don't compete for them
+    torch.set_num_threads(num_threads)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = range(rank * num_threads, (rank + 1) * num_threads)
+        os.sched_setaffinity(0, {core % os.cpu_count() for core in cores})
+
+    use_model(config, state_dict)
+    # each worker trains on every num_workers-th row
+    categorical_data, numerical_data, outputs_data = data
+    categorical_shard = categorical_data[rank::num_workers]
+    numerical_shard = numerical_data[rank::num_workers]
+    outputs_shard = outputs_data[rank::num_workers]
+
+    parallel_model = DistributedDataParallel(model)
+    train(parallel_model, model_config, categorical_shard, numerical_shard, outputs_shard, epochs, log=rank == 0)
+
+    # every worker has the same weights, so only the first needs to hand them back
+    if rank == 0:
+        torch.save(model.state_dict(), state_path)
+    torch.distributed.destroy_process_group()
+
+def train_model_distributed(num_workers, num_threads=1, epochs=None):
+    """
+    Train the model with data parallel training across num_workers processes,
+    each using num_threads threads. The trained weights are loaded back into the model,
+    so it can be tested and saved as usual.
+    """
+    logger.info('Training the model with {} workers of {} threads. This could take a long time...'.format(num_workers, num_threads))
+    # find a free port for the workers to talk to each other on
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    # fork where we can, so the workers share the already loaded training data
+    data = get_data(model_config)
+    start_method = 'fork' if 'fork' in torch.multiprocessing.get_all_start_methods() else 'spawn'
+    with tempfile.TemporaryDirectory() as state_dir:
+        state_path = os.path.join(state_dir, 'model.pt')
+        start = time.perf_counter()
+        torch.multiprocessing.start_processes(
+            train_worker,
+            args=(num_workers, num_threads, epochs, port, state_path, model_config, model.state_dict(), data),
+            nprocs=num_workers,
+            start_method=start_method
+        )
+        elapsed = time.perf_counter() - start
+        model.load_state_dict(torch.load(state_path, weights_only=True))
+    logger.info('Trained {} epochs with {} workers in {:.2f}s'.format(epochs or model_config['epochs'], num_workers, elapsed))
+    return elapsed
+
+def benchmark_training(max_workers, num_threads=1, epochs=50):
+    """
+    Log the scaling efficiency of data parallel training from 1 to max_workers workers.
+    The model's weights are restored afterwards, so it can then be trained from the same starting point.
+    """
+    initial_state = {key: value.clone() for key, value in model.state_dict().items()}
+    times = {}
+    for num_workers in range(1, max_workers + 1):
+        model.load_state_dict(initial_state)
+        times[num_workers] = train_model_distributed(num_workers, num_threads, epochs)
+    model.load_state_dict(initial_state)
+    for num_workers, elapsed in times.items():
+        logger.info('{} workers: {:.2f}s, speedup {:.2f}x, efficiency {:.0%}'.format(
+            num_workers, elapsed, times[1] / elapsed, times[1] / (elapsed * num_workers)))
+    return times
 
 def test_model():
     logger.info('Testing the model...')
     model.eval()
     loss_function = MSELoss()
+    categorical_data, numerical_data, outputs_data = get_data(model_config, test=True)
     with torch.no_grad():
-        predictions = model(categorical_test_data, numerical_test_data).squeeze()
-        loss = loss_function(predictions, test_outputs)
+        predictions = model(categorical_data, numerical_data).squeeze()
+        loss = loss_function(predictions, outputs_data)
     logger.info('MSE: %.3f, RMSE: %.3f' % (loss, sqrt(loss)))
 
-def predict_points(player_name, opposition_team_name, position, is_home, season, kickoff_time, round, cost, gameweek):
+# Number of MC dropout passes, chosen by calibrate_mc_samples the first time it's needed
+mc_samples = None
+
+def get_variance(categorical_data, numerical_data, samples=None):
+    """
+    Estimate the variance of the model's predictions with MC dropout. Every row is repeated for
+    each stochastic pass, and they're all run through the model in one batch with dropout left on
+    (batch norm stays in eval mode).
+    """
+    samples = samples or mc_samples or calibrate_mc_samples()
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, Dropout):
+            module.train()
+    try:
+        with torch.no_grad():
+            outputs = model(categorical_data.repeat(samples, 1), numerical_data.repeat(samples, 1))
+    finally:
+        model.eval()
+    return outputs.reshape(samples, len(categorical_data), -1).var(0)
+
+def calibrate_mc_samples(max_samples=constants.MC_DROPOUT_SAMPLES, budget=constants.MC_DROPOUT_LATENCY_BUDGET, num_rows=constants.MC_DROPOUT_POOL_ROWS):
+    """
+    Choose how many MC dropout passes to use: max_samples, halved until the passes for num_rows rows
+    (the whole player pool's fixtures) fit in the latency budget, in seconds.
+    The multi-horizon model predicts horizon fixtures in each row, so it's timed on fewer rows.
+    """
+    global mc_samples
+    categorical_data, numerical_data, outputs_data = get_data(model_config, test=True)
+    rows = torch.arange(-(-num_rows // model_config['horizon'])) % len(categorical_data)
+    samples = max_samples
+    while True:
+        start = time.perf_counter()
+        get_variance(categorical_data[rows], numerical_data[rows], samples)
+        elapsed = time.perf_counter() - start
+        if elapsed <= budget or samples <= 2:
+            break
+        samples //= 2
+    if elapsed > budget:
+        logger.warning('MC dropout takes {:.2f}s for {} rows with {} passes, over the budget of {:.2f}s'.format(elapsed, num_rows, samples, budget))
+    logger.info('Using {} MC dropout passes, {:.2f}s for {} rows'.format(samples, elapsed, num_rows))
+    mc_samples = samples
+    return mc_samples
+
+def predict_points(player_name, opposition_team_name, position, is_home, season, kickoff_time, round, cost, gameweek, with_variance=False):
     """
     Use the model to make a points prediction given the input data.
+    If with_variance is set, returns the prediction and its variance, estimated with MC dropout.
+    To predict several of a player's fixtures, use predict_points_fixtures rather than calling this for each.
+    """
+    return predict_points_fixtures(player_name, position, season, cost, [{
+        'opposition_team_name': opposition_team_name,
+        'is_home': is_home,
+        'kickoff_time': kickoff_time,
+        'round': round,
+        'gameweek': gameweek
+    }], with_variance)[0]
+
+def predict_points_fixtures(player_name, position, season, cost, fixtures, with_variance=False):
+    """
+    Use the model to predict the points for each of a player's upcoming fixtures, given as a list of dicts
+    with opposition_team_name, is_home, kickoff_time, round and gameweek.
+    Every fixture is predicted in one forward pass (in sequences of the horizon for the multi-horizon model).
+    If with_variance is set, returns a list of (prediction, variance) instead.
+    """
+    predictions = predict_points_pool([(player_name, position, season, cost, fixtures)], with_variance)[0]
+    if predictions is None:
+        raise ValueError('{} or one of their opponents is unknown to the model'.format(player_name))
+    return predictions
+
+def predict_points_pool(players, with_variance=False):
+    """
+    Predict the points for several players' fixtures at once, given a list of
+    (player_name, position, season, cost, fixtures) with the fixtures as for predict_points_fixtures.
+    The single fixture model takes a row per fixture, and the multi-horizon model a row per sequence
+    of horizon fixtures, with each player's last sequence padded by repeating their last fixture.
+    The numerical features for every row are derived in one add_features call, and every row is run
+    in one forward pass (and one batch of MC dropout passes).
+    Returns a list of each player's predictions (or (prediction, variance) pairs), or None for a player
+    if the model doesn't know them or one of their opponents (e.g. they're new this season).
     """
+    horizon = model_config['horizon']
+    categorical_rows = []
+    fixture_rows = []
+    num_rows = []
+    for player_name, position, season, cost, fixtures in players:
+        num_sequences = -(-len(fixtures) // horizon)
+        padded = fixtures + fixtures[-1:] * (num_sequences * horizon - len(fixtures))
+        player_ids = [get_player(player_name), get_position(position), get_season_id(season)]
+        fixture_ids = [[get_team(fixture['opposition_team_name']), get_was_home(fixture['is_home'])] for fixture in padded]
+        if None in player_ids or None in sum(fixture_ids, []):
+            num_rows.append(None)
+            continue
+        if horizon == 1:
+            categorical_rows += [[player_ids[0], team_id, player_ids[1], player_ids[2], was_home] for team_id, was_home in fixture_ids]
+        else:
+            categorical_rows += [player_ids + sum(fixture_ids[i:i + horizon], []) for i in range(0, len(padded), horizon)]
+        fixture_rows += [{
+            'kickoff_time': fixture['kickoff_time'],
+            'season_x': season,
+            'round': fixture['round'],
+            'value': cost,
+            'GW': fixture['gameweek']
+        } for fixture in padded]
+        num_rows.append(num_sequences)
+    if not categorical_rows:
+        return [None if rows is None else [] for rows in num_rows]
+
+    categorical_data = torch.tensor(categorical_rows, dtype=torch.int64)
+    # derive the numerical features the same way as the training data
+    rows = add_features(DataFrame(fixture_rows))
+    if horizon > 1:
+        # lay each sequence out in one row
+        rows = DataFrame({
+            '{}_{}'.format(col, offset): rows[col].values[offset::horizon]
+            for offset in range(horizon) for col in model_config['numerical_columns']
+        })
+    numerical_data = get_numerical_data(rows, model_config)
     model.eval()
     with torch.no_grad():
-        player_id = get_player(player_name)
-        opposition_team_id = get_team(opposition_team_name)
-        position_id = get_position(position)
-        season_id = get_season_id(season)
-        was_home = get_was_home(is_home)
-        categorical_data = torch.tensor([[player_id, opposition_team_id, position_id, season_id, was_home]], dtype=torch.int64)
-        numerical_data = torch.tensor([[parser.isoparse(kickoff_time).timestamp(), round, cost, gameweek]], dtype=torch.float)
-        return model(categorical_data, numerical_data).squeeze()
+        predictions = model(categorical_data, numerical_data).reshape(len(categorical_data), -1)
+    if with_variance:
+        variances = get_variance(categorical_data, numerical_data).reshape(len(categorical_data), -1)
+
+    results = []
+    row = 0
+    for (player_name, position, season, cost, fixtures), player_rows in zip(players, num_rows):
+        if player_rows is None:
+            results.append(None)
+            continue
+        # the padding is at the end of each player's rows, so ignore its extra predictions
+        player_predictions = predictions[row:row + player_rows].flatten()[:len(fixtures)].tolist()
+        if with_variance:
+            results.append(list(zip(player_predictions, variances[row:row + player_rows].flatten()[:len(fixtures)].tolist())))
+        else:
+            results.append(player_predictions)
+        row += player_rows
+    return results
+
+def use_model(config, state_dict=None):
+    """
+    Replace the model with a new one built from the config, optionally loading the given weights.
+    """
+    global model, model_config, mc_samples
+    model_config = dict(DEFAULT_MODEL_CONFIG, **config)
+    model = create_model(model_config)
+    # the new model may be slower or faster
+    mc_samples = None
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
 
 def load_model(path=DEFAULT_MODEL_PATH):
     logger.info('Loading model from {}'.format(os.path.join(os.getcwd(), path)))
-    model.load_state_dict(torch.load(path, weights_only=True))
+    checkpoint = torch.load(path, weights_only=True)
+    if 'config' in checkpoint:
+        config = checkpoint['config']
+        if 'numerical_columns' not in config:
+            # saved before the kickoff time features were added
+            config = dict(config, numerical_columns=LEGACY_NUMERICAL_COLUMNS)
+        use_model(config, checkpoint['state_dict'])
+    else:
+        # older models were saved without their config, so use the default architecture
+        use_model(dict(DEFAULT_MODEL_CONFIG, numerical_columns=LEGACY_NUMERICAL_COLUMNS), checkpoint)
 
 def save_model(path=DEFAULT_MODEL_PATH):
     logger.info('Saving model to {}'.format(os.path.join(os.getcwd(), path)))
-    torch.save(model.state_dict(), path)
+    torch.save({'config': model_config, 'state_dict': model.state_dict()}, path)
+
+def get_model_hash(path=DEFAULT_MODEL_PATH):
+    """
+    Hash the saved model, so anything derived from it can be invalidated when it changes.
+    """
+    with open(path, 'rb') as model_file:
+        return hashlib.sha1(model_file.read()).hexdigest()
@@ -4,6 +4,8 @@ Functions used to calculate the expected points total for a given player.
 import constants
 import logging
 import neural_network
+import prediction_cache
+import time
 import web_service
 
 logger = logging.getLogger()
@@ -14,16 +16,142 @@ HAS_MODEL_ERROR = {}
 # Same here, maintain a cache of multipliers to avoid recalculating
 INJURY_MULTIPLIERS = {}
 PAST_FIXTURE_MULTIPLIERS = {}
+# Map of team id to team name, so we only fetch the team data once
+TEAM_NAMES = {}
 
-def predict_points_multiple_gameweeks(player, fixture_data, num_gameweeks):
+def reduce_players(static_data):
     """
-    Attempt to predict total number of points across multiple gameweeks
+    Reduce the static data to just the fields needed for each player,
+    so the rest of the payload can be discarded.
     """
-    result = 0
-    for gameweek in range(num_gameweeks):
-        result += predict_points(player, fixture_data, gameweek)
-    logger.debug('Predicted points for {} {} over {} weeks: {}'.format(player['first_name'], player['second_name'], num_gameweeks, result))                                                                    
-    return result
+    return [{field: player.get(field) for field in constants.PLAYER_FIELDS} for player in static_data['elements']]
+
+
+def reduce_fixture_data(fixture_data):
+    """
+    Reduce a player's full fixture data to just what's needed to predict their points:
+    the fixtures within the prediction horizon and the minutes played in past games.
+    """
+    last_event = constants.NEXT_EVENT['id'] + constants.PREDICTION_HORIZON - 1
+    return {
+        'fixtures': [
+            {field: fixture[field] for field in constants.FIXTURE_FIELDS}
+            for fixture in fixture_data['fixtures']
+            if fixture['event'] is not None and fixture['event'] <= last_event
+        ],
+        'history': [{'minutes': fixture['minutes']} for fixture in fixture_data['history']],
+        'history_past': [{'minutes': season['minutes']} for season in fixture_data['history_past'][-1:]]
+    }
+
+
+def stream_fixture_data(all_players, fixtures=None):
+    """
+    Yield each player with their reduced fixture data, fetching one player at a time
+    so only one full fixture payload is held in memory.
+    If a fixtures dict (player id -> reduced fixture data) is given, any fixture data already in it
+    is reused instead of refetched, and newly fetched fixture data is added to it.
+    """
+    for player in all_players:
+        if fixtures is not None and player['id'] in fixtures:
+            yield player, fixtures[player['id']]
+            continue
+        fixture_data = reduce_fixture_data(web_service.get_player_fixtures(player['id']))
+        if fixtures is not None:
+            fixtures[player['id']] = fixture_data
+        yield player, fixture_data
+
+
+def predict_all_players(all_players, fixtures=None):
+    """
+    Predict the expected points for every player, both for this gameweek and over the prediction horizon.
+    Every player's fixtures are predicted by the model together, then each player's points are worked out.
+    """
+    # only the reduced fixture data is kept for the whole pool
+    players = list(stream_fixture_data(all_players, fixtures))
+    predict_fixtures(players, constants.PREDICTION_HORIZON)
+    for player, fixture_data in players:
+        constants.PLAYERS[player['id']] = player
+        predictions = predict_points_by_gameweek(player, fixture_data, constants.PREDICTION_HORIZON)
+        player['expected_points_by_gameweek'] = [points for points, variance in predictions]
+        player['expected_points_variance_by_gameweek'] = [variance for points, variance in predictions]
+        player['expected_points'] = sum(player['expected_points_by_gameweek'])
+        # treat each gameweek's prediction as independent, so the variances add up
+        player['expected_points_variance'] = sum(player['expected_points_variance_by_gameweek'])
+        player['expected_points_this_gameweek'] = player['expected_points_by_gameweek'][0]
+        player['expected_points_this_gameweek_variance'] = player['expected_points_variance_by_gameweek'][0]
+        player['injury_multiplier'] = calculate_injury_multiplier(player)
+        player['past_fixture_multiplier'] = calculate_past_fixture_multiplier(player, fixture_data)
+        logger.info('Predicted points for {} {}: {:.2f} (variance {:.2f})'.format(player['first_name'], player['second_name'], player['expected_points_this_gameweek'], player['expected_points_this_gameweek_variance']))
+    prediction_cache.commit()
+    return all_players
+
+
+def get_team_name(team_id):
+    """
+    Get a team's name from its id.
+    """
+    if not TEAM_NAMES:
+        for team in web_service.get_team_data():
+            TEAM_NAMES[team['id']] = team['name']
+    return TEAM_NAMES.get(team_id)
+
+
+def get_position(player):
+    """
+    Get the model's position name from a player's element_type.
+    """
+    return {1: 'GK', 2: 'DEF', 3: 'MID', 4: 'FWD'}.get(player['element_type'])
+
+
+def predict_fixtures(players, num_gameweeks):
+    """
+    Predict the model's points for all of the players' fixtures in the next num_gameweeks,
+    given a list of (player, fixture_data), and store them in the prediction cache.
+    The whole pool is stacked into one forward pass, so the MC dropout passes are also run once.
+    """
+    start = time.perf_counter()
+    first_event = constants.NEXT_EVENT['id']
+    pool = []
+    cache_keys = []
+    for player, fixture_data in players:
+        fixtures = [x for x in fixture_data['fixtures'] if first_event <= x['event'] < first_event + num_gameweeks]
+        player_cache_keys = [(player['id'], fixture['id'], fixture['kickoff_time'], player['now_cost']) for fixture in fixtures]
+        if all(prediction_cache.get_prediction(*cache_key) is not None for cache_key in player_cache_keys):
+            continue
+        pool.append((
+            '{} {}'.format(player['first_name'], player['second_name']),
+            get_position(player),
+            constants.CURRENT_SEASON,
+            player['now_cost'],
+            [{
+                'opposition_team_name': get_team_name(fixture['team_a'] if fixture['is_home'] else fixture['team_h']),
+                'is_home': fixture['is_home'],
+                'kickoff_time': fixture['kickoff_time'],
+                'round': fixture['event'],
+                'gameweek': fixture['event']
+            } for fixture in fixtures]
+        ))
+        cache_keys.append(player_cache_keys)
+    try:
+        model_predictions = neural_network.predict_points_pool(pool, with_variance=True)
+    except Exception as e:
+        # leave predict_points to fall back to the naive estimate
+        logger.debug(e, exc_info=True)
+        return
+    for player_cache_keys, player_predictions in zip(cache_keys, model_predictions):
+        # players the model doesn't know are left to the naive estimate too
+        for cache_key, (points, variance) in zip(player_cache_keys, player_predictions or []):
+            prediction_cache.set_prediction(*cache_key, points, variance)
+    logger.info('Predicted {} fixtures for {} players in {:.2f}s'.format(
+        sum(len(player_cache_keys) for player_cache_keys in cache_keys), len(cache_keys), time.perf_counter() - start))
+
+
+def predict_points_by_gameweek(player, fixture_data, num_gameweeks):
+    """
+    Attempt to predict the points in each of the next num_gameweeks, as a list of (points, variance).
+    The model's predictions are read from the prediction cache, filled by predict_fixtures.
+    """
+    return [predict_points_and_variance(player, fixture_data, gameweek) for gameweek in range(num_gameweeks)]
 
 
 def predict_points(player, fixture_data, gameweekOffset=0):
@@ -31,28 +159,32 @@ def predict_points(player, fixture_data, gameweekOffset=0):
     Given a player's json object, this function attempts to predict
     how many points a given player will score in the next gameweek.
     """
+    return predict_points_and_variance(player, fixture_data, gameweekOffset)[0]
+
+
+def predict_points_and_variance(player, fixture_data, gameweekOffset=0):
+    """
+    Predict a player's points in a gameweek, and the variance of the prediction.
+    """
     expected_points = 0
-    if player['element_type'] == 1:
-        position = 'GK'
-    elif player['element_type'] == 2:
-        position = 'DEF'
-    elif player['element_type'] == 3:
-        position = 'MID'
-    elif player['element_type'] == 4:
-        position = 'FWD'
+    variance = 0
+    position = get_position(player)
     gameweek = constants.NEXT_EVENT['id'] + gameweekOffset
     matches_this_gameweek = [x for x in fixture_data['fixtures'] if x['event'] == gameweek]
     for next_match in matches_this_gameweek:
         opposition_team_id = next_match['team_a'] if next_match[
             'is_home'] else next_match['team_h']
-        # Get data for all teams.
-        team_data = web_service.get_team_data()
-        for team in team_data:
-            if team['id'] == opposition_team_id:
-                opposition_team_name = team['name']
-                break
+        opposition_team_name = get_team_name(opposition_team_id)
+        # the model's prediction only depends on the fixture and the player's cost,
+        # so use the stored prediction if there is one
+        cache_key = (player['id'], next_match['id'], next_match['kickoff_time'], player['now_cost'])
+        cached_prediction = prediction_cache.get_prediction(*cache_key)
+        if cached_prediction is not None:
+            expected_points += cached_prediction[0]
+            variance += cached_prediction[1]
+            continue
         try:
-            expected_points += neural_network.predict_points(
+            model_points, model_variance = neural_network.predict_points(
                 '{} {}'.format(player['first_name'], player['second_name']),
                 opposition_team_name,
                 position,
@@ -61,8 +193,12 @@ def predict_points(player, fixture_data, gameweekOffset=0):
                 next_match['kickoff_time'],
                 next_match['event'],
                 player['now_cost'],
-                next_match['event']
+                next_match['event'],
+                with_variance=True
             )
+            prediction_cache.set_prediction(*cache_key, model_points, model_variance)
+            expected_points += model_points
+            variance += model_variance
         except Exception as e:
             # if the model fails for some reason, fall back to a naive average
             # this can happen for a few reasons:
@@ -73,12 +209,15 @@ def predict_points(player, fixture_data, gameweekOffset=0):
                 logger.debug(e, exc_info=True)
                 HAS_MODEL_ERROR[player['id']] = True
             expected_points += float(player['points_per_game'])
+            # treat the points as poisson distributed, so the variance is the mean
+            variance += float(player['points_per_game'])
 
     injury_ratio = calculate_injury_multiplier(player)
     past_fixture_ratio = calculate_past_fixture_multiplier(player, fixture_data)
     result = expected_points * injury_ratio * past_fixture_ratio
-    logger.debug('Predicted points for {} {} in gameweek {}: {}'.format(player['first_name'], player['second_name'], gameweek, result))                                                                    
-    return result
+    result_variance = variance * (injury_ratio * past_fixture_ratio) ** 2
+    logger.debug('Predicted points for {} {} in gameweek {}: {} (variance {})'.format(player['first_name'], player['second_name'], gameweek, result, result_variance))
+    return result, result_variance
 
 
 def calculate_injury_multiplier(player):
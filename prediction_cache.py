@@ -0,0 +1,78 @@
+"""
+Persistent store of the model's predicted points, so unchanged predictions aren't recalculated.
+Predictions (the points and their MC dropout variance) are keyed by player, fixture, kickoff time,
+cost and the hash of the model, and every stored prediction is evicted whenever the model file changes.
+"""
+import constants
+import logging
+import neural_network
+import sqlite3
+
+logger = logging.getLogger()
+
+# Lazily opened, so the model hash is read after the model has been loaded/saved
+CONNECTION = None
+MODEL_HASH = None
+
+
+def open_cache(path=constants.PREDICTION_CACHE_PATH):
+    """
+    Open the prediction cache, evicting every prediction if the model has changed.
+    """
+    global CONNECTION, MODEL_HASH
+    MODEL_HASH = neural_network.get_model_hash()
+    CONNECTION = sqlite3.connect(path)
+    columns = [row[1] for row in CONNECTION.execute('PRAGMA table_info(predictions)')]
+    if columns and 'variance' not in columns:
+        logger.info('Prediction cache has no variances, recreating it')
+        CONNECTION.execute('DROP TABLE predictions')
+    CONNECTION.execute('''
+        CREATE TABLE IF NOT EXISTS predictions (
+            element INTEGER,
+            fixture INTEGER,
+            kickoff_time TEXT,
+            cost INTEGER,
+            model TEXT,
+            points REAL,
+            variance REAL,
+            PRIMARY KEY (element, fixture, kickoff_time, cost, model)
+        )
+    ''')
+    CONNECTION.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    row = CONNECTION.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+    if row is None or row[0] != MODEL_HASH:
+        logger.info('Model has changed, evicting cached predictions')
+        CONNECTION.execute('DELETE FROM predictions')
+        CONNECTION.execute("INSERT OR REPLACE INTO meta VALUES ('model', ?)", (MODEL_HASH,))
+        CONNECTION.commit()
+    return CONNECTION
+
+
+def get_prediction(element, fixture, kickoff_time, cost):
+    """
+    Get a stored prediction as (points, variance), or None if there isn't one for the current model.
+    """
+    if CONNECTION is None:
+        open_cache()
+    row = CONNECTION.execute(
+        'SELECT points, variance FROM predictions WHERE element = ? AND fixture = ? AND kickoff_time = ? AND cost = ? AND model = ?',
+        (element, fixture, kickoff_time, cost, MODEL_HASH)
+    ).fetchone()
+    return row
+
+
+def set_prediction(element, fixture, kickoff_time, cost, points, variance):
+    """
+    Store a prediction. Call commit() to write the stored predictions to disk.
+    """
+    if CONNECTION is None:
+        open_cache()
+    CONNECTION.execute(
+        'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (element, fixture, kickoff_time, cost, MODEL_HASH, points, variance)
+    )
+
+
+def commit():
+    if CONNECTION is not None:
+        CONNECTION.commit()
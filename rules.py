@@ -0,0 +1,140 @@
+"""
+Check squads, transfers and starting lineups against the fantasy premier league rules,
+so invalid changes are caught locally rather than by the server.
+Each function returns a list of the rules broken, which is empty if everything is valid.
+players is a dict of player id -> player json object, e.g. constants.PLAYERS.
+"""
+import constants
+
+# Squad size and starting lineup limits for each element_type
+SQUAD_SIZE = constants.SQUAD_NUM_GOALKEEPERS + constants.SQUAD_NUM_DEFENDERS + constants.SQUAD_NUM_MIDFIELDERS + constants.SQUAD_NUM_ATTACKERS
+SQUAD_NUM_PER_TYPE = {
+    1: constants.SQUAD_NUM_GOALKEEPERS,
+    2: constants.SQUAD_NUM_DEFENDERS,
+    3: constants.SQUAD_NUM_MIDFIELDERS,
+    4: constants.SQUAD_NUM_ATTACKERS
+}
+STARTING_MIN_PER_TYPE = {
+    1: constants.STARTING_MIN_GOALKEEPERS,
+    2: constants.STARTING_MIN_DEFENDERS,
+    3: constants.STARTING_MIN_MIDFIELDERS,
+    4: constants.STARTING_MIN_ATTACKERS
+}
+
+
+def validate_squad(squad_ids, players):
+    """
+    Check a squad (list of player ids) has the right number of players in each position
+    and not too many players from the same team.
+    """
+    violations = []
+    if len(squad_ids) != SQUAD_SIZE:
+        violations.append('Squad has {} players, expected {}'.format(len(squad_ids), SQUAD_SIZE))
+    if len(set(squad_ids)) != len(squad_ids):
+        violations.append('Squad contains the same player more than once')
+    type_counts = {}
+    team_counts = {}
+    for player_id in squad_ids:
+        player = players.get(player_id)
+        if player is None:
+            violations.append('Unknown player {}'.format(player_id))
+            continue
+        type_counts[player['element_type']] = type_counts.get(player['element_type'], 0) + 1
+        team_counts[player['team']] = team_counts.get(player['team'], 0) + 1
+    for element_type, num_players in SQUAD_NUM_PER_TYPE.items():
+        if type_counts.get(element_type, 0) != num_players:
+            violations.append('Squad has {} players of type {}, expected {}'.format(type_counts.get(element_type, 0), element_type, num_players))
+    for team, num_players in team_counts.items():
+        if num_players > constants.SQUAD_MAX_PLAYERS_SAME_TEAM:
+            violations.append('Squad has {} players from team {}, the maximum is {}'.format(num_players, team, constants.SQUAD_MAX_PLAYERS_SAME_TEAM))
+    return violations
+
+
+def validate_transfers(transfer_object, current_squad, players):
+    """
+    Check a transfers object against the current squad (the my-team json object):
+    each transfer swaps a squad player for a new player of the same type,
+    the bank can afford it, any chip is available and the new squad is valid.
+    """
+    violations = []
+    transfers = transfer_object['transfers']
+    current_squad_ids = [pick['element'] for pick in current_squad['picks']]
+    selling_prices = {pick['element']: pick['selling_price'] for pick in current_squad['picks']}
+    elements_in = [transfer['element_in'] for transfer in transfers]
+    elements_out = [transfer['element_out'] for transfer in transfers]
+    if len(set(elements_in)) != len(elements_in) or len(set(elements_out)) != len(elements_out):
+        violations.append('The same player is transferred more than once')
+
+    bank = current_squad['transfers']['bank']
+    for transfer in transfers:
+        if transfer['element_out'] not in selling_prices:
+            violations.append('Player {} is not in the squad'.format(transfer['element_out']))
+            continue
+        if transfer['element_in'] in selling_prices:
+            violations.append('Player {} is already in the squad'.format(transfer['element_in']))
+        player_in = players.get(transfer['element_in'])
+        player_out = players.get(transfer['element_out'])
+        if player_in is None or player_out is None:
+            violations.append('Unknown player in transfer {}'.format(transfer))
+            continue
+        if player_in['element_type'] != player_out['element_type']:
+            violations.append('Player {} (type {}) cannot replace player {} (type {})'.format(
+                player_in['id'], player_in['element_type'], player_out['id'], player_out['element_type']))
+        if transfer['selling_price'] != selling_prices[transfer['element_out']]:
+            violations.append('Selling price for player {} is {}, expected {}'.format(
+                transfer['element_out'], transfer['selling_price'], selling_prices[transfer['element_out']]))
+        if transfer['purchase_price'] != player_in['now_cost']:
+            violations.append('Purchase price for player {} is {}, expected {}'.format(
+                transfer['element_in'], transfer['purchase_price'], player_in['now_cost']))
+        bank += selling_prices[transfer['element_out']] - player_in['now_cost']
+    if bank < 0:
+        violations.append('Transfers are over budget by {}'.format(-bank))
+
+    chip = transfer_object.get('chip')
+    if chip is not None:
+        available_chips = [x['name'] for x in current_squad.get('chips', []) if x['status_for_entry'] == 'available']
+        if chip not in available_chips:
+            violations.append('Chip {} is not available'.format(chip))
+
+    new_squad_ids = [player_id for player_id in current_squad_ids if player_id not in elements_out] + elements_in
+    return violations + validate_squad(new_squad_ids, players)
+
+
+def validate_lineup(starting_lineup, players, squad_ids=None):
+    """
+    Check a starting lineup: the squad is valid (and is the given squad, if squad_ids is given),
+    the positions are 1-15, the starting players make a valid formation, the first sub is
+    a goalkeeper and there's exactly one captain and vice captain, both starting.
+    """
+    picks = starting_lineup['picks']
+    violations = validate_squad([pick['element'] for pick in picks], players)
+    if violations:
+        return violations
+    if squad_ids is not None and sorted(pick['element'] for pick in picks) != sorted(squad_ids):
+        violations.append('Starting lineup players {} are not the squad {}'.format(
+            sorted(set(pick['element'] for pick in picks) - set(squad_ids)), sorted(set(squad_ids) - set(pick['element'] for pick in picks))))
+    if sorted(pick['position'] for pick in picks) != list(range(1, SQUAD_SIZE + 1)):
+        violations.append('Positions must be 1 to {}'.format(SQUAD_SIZE))
+    type_counts = {}
+    for pick in picks:
+        element_type = players[pick['element']]['element_type']
+        if pick['position'] <= constants.STARTING_SIZE:
+            type_counts[element_type] = type_counts.get(element_type, 0) + 1
+        elif pick['position'] == constants.STARTING_SIZE + 1 and element_type != 1:
+            violations.append('The first sub must be a goalkeeper')
+        elif pick['position'] > constants.STARTING_SIZE + 1 and element_type == 1:
+            violations.append('Only the first sub can be a goalkeeper')
+    if type_counts.get(1, 0) != constants.STARTING_MIN_GOALKEEPERS:
+        violations.append('Starting lineup must have {} goalkeeper'.format(constants.STARTING_MIN_GOALKEEPERS))
+    for element_type, min_players in STARTING_MIN_PER_TYPE.items():
+        if type_counts.get(element_type, 0) < min_players:
+            violations.append('Starting lineup has {} players of type {}, the minimum is {}'.format(type_counts.get(element_type, 0), element_type, min_players))
+    for role in ('is_captain', 'is_vice_captain'):
+        chosen = [pick for pick in picks if pick[role] in (True, 'true')]
+        if len(chosen) != 1:
+            violations.append('Starting lineup must have exactly one {}'.format(role))
+        elif chosen[0]['position'] > constants.STARTING_SIZE:
+            violations.append('The {} must be in the starting lineup'.format(role))
+    if any(pick['is_captain'] in (True, 'true') and pick['is_vice_captain'] in (True, 'true') for pick in picks):
+        violations.append('The captain cannot also be the vice captain')
+    return violations
@@ -0,0 +1,145 @@
+"""
+Save each run's players, predictions and solver inputs/outputs as a versioned columnar snapshot,
+so they can be analysed, or the squad re-solved, without fetching the data or loading the model.
+Each snapshot is a directory of Parquet files under constants.RUN_SNAPSHOT_DIR:
+    players.parquet: the player table, with their expected points and multipliers (the solver's input)
+    predictions.parquet: each player's expected points, and their variance, in each gameweek of the prediction horizon
+    entries.parquet: each entry's current squad (the my-team json object, as a string)
+    selections.parquet: each entry's new squad and starting lineup (the solver's output)
+The snapshot version, event and model hash are stored in the metadata of players.parquet.
+"""
+import constants
+import datetime
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger()
+
+# Fields saved for each player on top of constants.PLAYER_FIELDS
+PREDICTED_FIELDS = [
+    'expected_points', 'expected_points_this_gameweek', 'expected_points_variance', 'expected_points_this_gameweek_variance',
+    'injury_multiplier', 'past_fixture_multiplier'
+]
+
+
+def get_latest_snapshot(snapshot_dir=constants.RUN_SNAPSHOT_DIR):
+    """
+    Get the path of the most recent snapshot, or None if there aren't any.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return None
+    # the directory names start with the time, so they sort oldest first
+    snapshots = sorted(os.listdir(snapshot_dir))
+    return os.path.join(snapshot_dir, snapshots[-1]) if snapshots else None
+
+
+def save_snapshot(all_players, changes=None, snapshot_dir=constants.RUN_SNAPSHOT_DIR):
+    """
+    Save the predicted players and, if given, each entry's changes
+    (a list of (entry, current_squad, new_squad, new_starting, chip) from main.calculate_changes).
+    Returns the path of the new snapshot.
+    """
+    # imported here as pyarrow is slow to import, and already loaded when predicting
+    import neural_network
+    import pyarrow
+    import pyarrow.parquet
+    start = time.perf_counter()
+    created = datetime.datetime.now(datetime.timezone.utc)
+    path = os.path.join(snapshot_dir, '{}-event-{}'.format(created.strftime('%Y%m%dT%H%M%S'), constants.NEXT_EVENT['id']))
+    os.makedirs(path, exist_ok=True)
+
+    players = pyarrow.Table.from_pylist([
+        {field: player.get(field) for field in constants.PLAYER_FIELDS + PREDICTED_FIELDS} for player in all_players
+    ])
+    players = players.replace_schema_metadata({'snapshot': json.dumps({
+        'version': constants.RUN_SNAPSHOT_VERSION,
+        'event': constants.NEXT_EVENT['id'],
+        'model': neural_network.get_model_hash(),
+        'created': created.isoformat()
+    })})
+    predictions = pyarrow.Table.from_pylist([{
+        'element': player['id'],
+        'gameweek': constants.NEXT_EVENT['id'] + offset,
+        'expected_points': points,
+        'variance': variance
+    } for player in all_players for offset, (points, variance) in enumerate(zip(
+        player['expected_points_by_gameweek'], player['expected_points_variance_by_gameweek']
+    ))])
+    entries = pyarrow.Table.from_pylist([{
+        'entry': entry.get('id'),
+        'username': entry.get('username'),
+        'current_squad': json.dumps(current_squad) if current_squad is not None else None
+    } for entry, current_squad, new_squad, new_starting, chip in changes or []], schema=pyarrow.schema([
+        ('entry', pyarrow.int64()), ('username', pyarrow.string()), ('current_squad', pyarrow.string())
+    ]))
+    selections = pyarrow.Table.from_pylist([{
+        'entry': entry.get('id'),
+        'element': pick['element'],
+        'position': pick['position'],
+        'is_captain': pick['is_captain'] in (True, 'true'),
+        'is_vice_captain': pick['is_vice_captain'] in (True, 'true'),
+        'chip': chip
+    } for entry, current_squad, new_squad, new_starting, chip in changes or [] for pick in new_starting['picks']], schema=pyarrow.schema([
+        ('entry', pyarrow.int64()), ('element', pyarrow.int64()), ('position', pyarrow.int64()),
+        ('is_captain', pyarrow.bool_()), ('is_vice_captain', pyarrow.bool_()), ('chip', pyarrow.string())
+    ]))
+
+    for name, table in (('players', players), ('predictions', predictions), ('entries', entries), ('selections', selections)):
+        pyarrow.parquet.write_table(table, os.path.join(path, name + '.parquet'))
+    logger.info('Saved snapshot to {} in {:.2f}s'.format(path, time.perf_counter() - start))
+    return path
+
+
+def load_previous_squad(entry_id, snapshot_dir=constants.RUN_SNAPSHOT_DIR):
+    """
+    Get an entry's new squad (list of player ids) from the latest snapshot that has one,
+    so the solver can be warm started from the previous run's solution. Returns None if there isn't one.
+    """
+    import pyarrow.parquet
+    if entry_id is None or not os.path.isdir(snapshot_dir):
+        return None
+    # e.g. predict runs don't save any selections, so look back to the latest one that did
+    for snapshot in sorted(os.listdir(snapshot_dir), reverse=True):
+        path = os.path.join(snapshot_dir, snapshot, 'selections.parquet')
+        if not os.path.exists(path):
+            continue
+        selections = pyarrow.parquet.read_table(path, columns=['entry', 'element'], filters=[('entry', '=', entry_id)])
+        if selections.num_rows > 0:
+            logger.debug('Warm starting {} from the squad in {}'.format(entry_id, snapshot))
+            return selections.column('element').to_pylist()
+    return None
+
+
+def load_snapshot(path):
+    """
+    Load the players and each entry's current squad from a snapshot, ready to pass to the solver.
+    Returns (all_players, [(entry, current_squad), ...]), or None if the snapshot can't be used.
+    """
+    import pyarrow.parquet
+    start = time.perf_counter()
+    players = pyarrow.parquet.read_table(os.path.join(path, 'players.parquet'))
+    metadata = json.loads(players.schema.metadata[b'snapshot'])
+    if metadata['version'] != constants.RUN_SNAPSHOT_VERSION:
+        logger.error('Snapshot {} is version {}, expected version {}'.format(path, metadata['version'], constants.RUN_SNAPSHOT_VERSION))
+        return None
+
+    all_players = players.to_pylist()
+    players_by_id = {player['id']: player for player in all_players}
+    for player in all_players:
+        player['expected_points_by_gameweek'] = []
+        player['expected_points_variance_by_gameweek'] = []
+    # the predictions are saved in gameweek order for each player
+    for prediction in pyarrow.parquet.read_table(os.path.join(path, 'predictions.parquet')).to_pylist():
+        players_by_id[prediction['element']]['expected_points_by_gameweek'].append(prediction['expected_points'])
+        players_by_id[prediction['element']]['expected_points_variance_by_gameweek'].append(prediction['variance'])
+    constants.PLAYERS.update(players_by_id)
+    constants.NEXT_EVENT = {'id': metadata['event']}
+
+    entries = [
+        ({'id': entry['entry'], 'username': entry['username']}, json.loads(entry['current_squad']) if entry['current_squad'] is not None else None)
+        for entry in pyarrow.parquet.read_table(os.path.join(path, 'entries.parquet')).to_pylist()
+    ]
+    logger.info('Loaded snapshot {} (event {}, created {}) in {:.2f}s'.format(path, metadata['event'], metadata['created'], time.perf_counter() - start))
+    return all_players, entries
@@ -0,0 +1,110 @@
+"""
+Long running daemon mode.
+Keeps the model loaded and polls the next deadline, so that:
+    1. A while before the deadline, every player's fixtures are fetched and their points predicted.
+    2. Shortly before the deadline, only the static data (injuries, prices etc.) is refetched,
+       the players that have changed are re-predicted and the final squad is solved.
+The clock and sleep functions can be swapped out, e.g. for a fake clock when testing against a
+local stub of the API (see FANTASY_PL_URL in constants).
+"""
+from dateutil import parser
+import change_detection
+import constants
+import logging
+import points
+import requests
+import time
+import web_service
+
+logger = logging.getLogger()
+
+
+def get_deadline_timestamp():
+    """
+    Get the next transfer deadline as an epoch timestamp.
+    """
+    return parser.isoparse(constants.TRANSFER_DEADLINE).timestamp()
+
+
+def prefetch(fixtures):
+    """
+    Fetch every player's fixtures into the fixtures dict and predict their points.
+    """
+    fixtures.clear()
+    return change_detection.predict_changed_players(points.reduce_players(web_service.get_all_player_data()), fixtures)
+
+
+def refresh(static_data, fixtures):
+    """
+    Re-predict the points of any player whose static data has changed since the prefetch.
+    Only players that have changed or weren't prefetched (e.g. new signings) have their fixtures fetched.
+    """
+    return change_detection.predict_changed_players(points.reduce_players(static_data), fixtures)
+
+
+def run(calculate_changes, apply_changes=None,
+        prefetch_lead=constants.DAEMON_PREFETCH_LEAD,
+        final_lead=constants.DAEMON_FINAL_LEAD,
+        poll_interval=constants.DAEMON_POLL_INTERVAL,
+        clock=time.time, sleep=time.sleep, max_events=None):
+    """
+    Poll the next deadline forever (or until max_events deadlines have been handled).
+    calculate_changes(all_players) should return the changes to make,
+    which are then passed to apply_changes if given.
+    A failed request is logged and retried at the next poll, and between seasons it waits for the next event.
+    """
+    fixtures = {}
+    prefetched_event = None
+    finished_event = None
+    num_events = 0
+    while max_events is None or num_events < max_events:
+        try:
+            static_data = web_service.get_all_player_data()
+            next_event = web_service.update_next_event(static_data)
+            if next_event is None:
+                # the season is over, so wait for the next season's data
+                sleep(poll_interval)
+                continue
+            deadline = get_deadline_timestamp()
+            now = clock()
+            logger.debug('Next event is {}, deadline in {:.0f}s'.format(next_event['id'], deadline - now))
+
+            if next_event['id'] != finished_event:
+                if now >= deadline:
+                    # too late to make any changes, e.g. the static data hasn't moved on to the next event yet
+                    logger.warning('Deadline for event {} has already passed, skipping it'.format(next_event['id']))
+                    finished_event = next_event['id']
+                    fixtures.clear()
+                elif now >= deadline - final_lead:
+                    logger.info('Making the final solve for event {}'.format(next_event['id']))
+                    if prefetched_event == next_event['id']:
+                        all_players = refresh(static_data, fixtures)
+                    else:
+                        all_players = prefetch(fixtures)
+                    changes = calculate_changes(all_players)
+                    if apply_changes is not None:
+                        apply_changes(changes)
+                    finished_event = next_event['id']
+                    num_events += 1
+                    fixtures.clear()
+                    continue
+                elif now >= deadline - prefetch_lead and prefetched_event != next_event['id']:
+                    logger.info('Prefetching the data for event {}'.format(next_event['id']))
+                    calculate_changes(prefetch(fixtures))
+                    prefetched_event = next_event['id']
+        except requests.RequestException as e:
+            # e.g. the API is down for a moment, so try again at the next poll rather than stopping the daemon
+            logger.error('Request failed, retrying in {:.0f}s: {}'.format(poll_interval, e))
+            logger.debug(e, exc_info=True)
+            sleep(poll_interval)
+            continue
+
+        # Sleep until the next thing to do, but poll at least every poll_interval
+        if next_event['id'] == finished_event:
+            wait = poll_interval
+        elif prefetched_event != next_event['id'] and now < deadline - prefetch_lead:
+            wait = min(poll_interval, deadline - prefetch_lead - now)
+        else:
+            wait = min(poll_interval, deadline - final_lead - now)
+        logger.debug('Sleeping for {:.0f}s'.format(max(wait, 0)))
+        sleep(max(wait, 0))
@@ -0,0 +1,202 @@
+"""
+Hyperparameter sweep over the model architecture and optimiser settings.
+Every combination in the search space is trained in parallel across a pool of processes,
+trials that are doing worse than the median of the other trials are stopped early, and the
+fastest of the trials within rmse_tolerance of the best validation RMSE wins. The trials that
+no other trial beats on both RMSE and inference latency (the Pareto front) are logged too.
+The best model is saved along with its config, so load_model rebuilds the right architecture.
+
+    python3 sweep.py data/sweep_config.json
+
+The config file has a search_space, mapping each setting in neural_network.DEFAULT_MODEL_CONFIG
+to a list of values to try, and optional settings for the sweep itself:
+    workers: number of trials to train at once (default: 1)
+    threads: number of threads for each trial (default: 1)
+    report_every: how often (in epochs) to compare trials for early stopping (default: 100)
+    min_epochs: don't stop any trial before this many epochs (default: 500)
+    rmse_tolerance: how much worse than the best RMSE (as a fraction) a trial can be and still win on latency (default: 0.01)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from numpy import median, random, sqrt
+from torch.nn import MSELoss
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import neural_network
+import sys
+import time
+import torch
+
+logger = logging.getLogger()
+
+# The number of rows to time inference on, roughly the number of players in the game
+LATENCY_BATCH_SIZE = 700
+
+# Shared between the workers, set up by init_worker
+SHARED_LOSSES = None
+SHARED_LOSSES_LOCK = None
+
+
+def get_candidates(search_space):
+    """
+    Get every combination of the values in the search space.
+    """
+    keys = list(search_space.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(search_space[key] for key in keys))]
+
+
+def init_worker(shared_losses, shared_losses_lock, num_threads):
+    global SHARED_LOSSES, SHARED_LOSSES_LOCK
+    SHARED_LOSSES = shared_losses
+    SHARED_LOSSES_LOCK = shared_losses_lock
+    torch.set_num_threads(num_threads)
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def measure_latency(network, repeats=20):
+    """
+    Get the median time in milliseconds to predict the points for a batch of LATENCY_BATCH_SIZE rows.
+    """
+    network.eval()
+    categorical_data = neural_network.categorical_test_data[:LATENCY_BATCH_SIZE]
+    numerical_data = neural_network.numerical_test_data[:LATENCY_BATCH_SIZE]
+    timings = []
+    with torch.no_grad():
+        for i in range(repeats):
+            start = time.perf_counter()
+            network(categorical_data, numerical_data)
+            timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
+
+
+def run_trial(trial_id, candidate, training, validation, report_every, min_epochs):
+    """
+    Train a single candidate config, stopping early if its validation loss is worse than
+    the median of the other trials' at the same epoch.
+    """
+    # start from the current config, so the trials keep the training data's normalisation
+    config = dict(neural_network.model_config, **candidate)
+    network = neural_network.create_model(config)
+    loss_function = MSELoss()
+    stopped_at = None
+
+    def on_epoch(epoch, loss):
+        nonlocal stopped_at
+        if (epoch + 1) % report_every != 0:
+            return True
+        network.eval()
+        with torch.no_grad():
+            validation_loss = loss_function(network(validation[0], validation[1]).squeeze(), validation[2]).item()
+        network.train()
+        with SHARED_LOSSES_LOCK:
+            losses = SHARED_LOSSES.get(epoch, [])
+            SHARED_LOSSES[epoch] = losses + [validation_loss]
+        if min_epochs <= epoch + 1 < config['epochs'] and losses and validation_loss > median(losses):
+            stopped_at = epoch + 1
+            return False
+        return True
+
+    start = time.perf_counter()
+    neural_network.train(network, config, *training, on_epoch=on_epoch, log=False)
+    training_time = time.perf_counter() - start
+
+    network.eval()
+    with torch.no_grad():
+        validation_loss = loss_function(network(validation[0], validation[1]).squeeze(), validation[2]).item()
+    return {
+        'trial': trial_id,
+        'config': config,
+        'rmse': float(sqrt(validation_loss)),
+        'latency_ms': float(measure_latency(network)),
+        'training_time': training_time,
+        'stopped_at': stopped_at,
+        'state_dict': network.state_dict() if stopped_at is None else None
+    }
+
+
+def rank_results(results, rmse_tolerance):
+    """
+    Sort the trial results best first: the completed trials within rmse_tolerance (a fraction)
+    of the best RMSE, fastest first, then the rest of the completed trials by RMSE, then the stopped trials.
+    """
+    completed = [result for result in results if result['stopped_at'] is None] or results
+    max_rmse = min(result['rmse'] for result in completed) * (1 + rmse_tolerance)
+    return sorted(results, key=lambda result: (
+        result['stopped_at'] is not None,
+        result['rmse'] > max_rmse,
+        result['latency_ms'] if result['rmse'] <= max_rmse else result['rmse']
+    ))
+
+
+def get_pareto_front(results):
+    """
+    Get the completed trials that no other completed trial beats on both RMSE and latency, most accurate first.
+    """
+    completed = [result for result in results if result['stopped_at'] is None]
+    return sorted([result for result in completed if not any(
+        other['rmse'] <= result['rmse'] and other['latency_ms'] <= result['latency_ms'] and other is not result
+        and (other['rmse'] < result['rmse'] or other['latency_ms'] < result['latency_ms'])
+        for other in completed
+    )], key=lambda result: result['rmse'])
+
+
+def run_sweep(sweep_config):
+    """
+    Train every candidate in the sweep config and return the results, best first.
+    """
+    candidates = get_candidates(sweep_config['search_space'])
+    workers = sweep_config.get('workers', 1)
+    threads = sweep_config.get('threads', 1)
+    logger.info('Sweeping {} candidates with {} workers of {} threads'.format(len(candidates), workers, threads))
+
+    # hold out some of the training data for validation, so the test data stays unseen
+    msk = random.rand(len(neural_network.training_outputs)) < 0.9
+    msk = torch.tensor(msk)
+    training = (neural_network.categorical_training_data[msk], neural_network.numerical_training_data[msk], neural_network.training_outputs[msk])
+    validation = (neural_network.categorical_training_data[~msk], neural_network.numerical_training_data[~msk], neural_network.training_outputs[~msk])
+
+    # fork where we can, so the workers share the already loaded dataset
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with multiprocessing.Manager() as manager:
+        shared_losses = manager.dict()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(shared_losses, manager.Lock(), threads)) as executor:
+            futures = [executor.submit(
+                run_trial, trial_id, candidate, training, validation,
+                sweep_config.get('report_every', 100), sweep_config.get('min_epochs', 500)
+            ) for trial_id, candidate in enumerate(candidates)]
+            results = [future.result() for future in futures]
+
+    rmse_tolerance = sweep_config.get('rmse_tolerance', 0.01)
+    results = rank_results(results, rmse_tolerance)
+    for result in results:
+        logger.info('Trial {}: RMSE {:.3f}, latency {:.2f}ms, trained in {:.1f}s{}, config {}'.format(
+            result['trial'], result['rmse'], result['latency_ms'], result['training_time'],
+            ' (stopped at epoch {})'.format(result['stopped_at']) if result['stopped_at'] else '',
+            result['config']))
+    logger.info('Pareto front of RMSE and latency: {}'.format(', '.join(
+        'trial {} ({:.3f}, {:.2f}ms)'.format(result['trial'], result['rmse'], result['latency_ms']) for result in get_pareto_front(results))))
+    logger.info('Best trial: {}, the fastest within {:.0%} of the best RMSE'.format(results[0]['trial'], rmse_tolerance))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep for the points prediction model')
+    parser.add_argument('config', help='Path to the sweep config file')
+    parser.add_argument('--output', help='Where to save the best model (default: "{}")'.format(neural_network.DEFAULT_MODEL_PATH), default=neural_network.DEFAULT_MODEL_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+    )
+
+    with open(args.config) as config_file:
+        results = run_sweep(json.load(config_file))
+    best = results[0]
+    logger.info('Best config: {}'.format(best['config']))
+    neural_network.use_model(best['config'], best['state_dict'])
+    neural_network.test_model()
+    neural_network.save_model(args.output)
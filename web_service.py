@@ -1,24 +1,42 @@
 """
 Functions to manage CRUD operations on fantasy.premierleague.com.
 """
+import base64
+import getpass
 import json
+import os
 import requests
 import constants
 import logging
-from playwright.sync_api import sync_playwright
+import rules
+import time
 
 logger = logging.getLogger()
 # Create a session - this persists cookies across requests
 MY_SESSION = requests.Session()
+# The logged in entry. Holds its session, its squad id and the credentials,
+# so we can log in again if the bearer token is rejected.
+# Use new_entry() to log in to more than one entry at once.
+MY_ENTRY = {'session': MY_SESSION}
+
+
+def new_entry():
+    """
+    Create a new entry with its own session, for logging in to more than one entry at once.
+    """
+    return {'session': requests.Session()}
 
 def get_deadline_date():
     """
-    Get the next deadline for submitting transfers/team choice
+    Get the next deadline for submitting transfers/team choice (None if the season is over)
     """
     static_data = MY_SESSION.get(constants.FANTASY_API_URL).json()
     events = static_data['events'];
-    next_event = next(x for x in events if x["is_next"] == True)
+    next_event = next((x for x in events if x["is_next"] == True), None)
     logger.debug('Next event is {}'.format(next_event))
+    if next_event is None:
+        logger.info('There is no next deadline, the season is over')
+        return None
     result = next_event['deadline_time'].split('T')[0]
     logger.info('Deadline is {}'.format(result))
     return result
@@ -27,7 +45,7 @@ def get_team_data():
     team_data = MY_SESSION.get(constants.FANTASY_API_URL).json()['teams']
     return team_data
 
-def get_transfers_squad():
+def get_transfers_squad(entry=MY_ENTRY):
     """
     Get the current selected squad from the transfers page.
     This gives more information about transfers, such as selling price.
@@ -36,9 +54,9 @@ def get_transfers_squad():
     squad_request_headers = {
         'X-Requested-With': 'XMLHttpRequest'
     }
-    result = MY_SESSION.get(constants.SQUAD_URL,
-                            headers=squad_request_headers).json()
-    logger.debug('Current transfers squad is {}'.format(result))
+    result = authorised_request('GET', entry['squad_url'], entry,
+                                headers=squad_request_headers).json()
+    logger.debug('Current transfers squad is {}'.format(result.get('picks')))
     return result
 
 
@@ -47,7 +65,16 @@ def get_all_player_data():
     Grab all the json data from the fantasy api url.
     """
     result = MY_SESSION.get(constants.FANTASY_API_URL).json()
-    logger.debug('Got player data: {}'.format(json.dumps(result)[:100], '...'))
+    logger.debug('Got player data for {} players'.format(len(result['elements'])))
+    return result
+
+
+def get_all_fixtures():
+    """
+    Grab every fixture in the season.
+    """
+    result = MY_SESSION.get(constants.FANTASY_FIXTURES_API_URL).json()
+    logger.debug('Got {} fixtures'.format(len(result)))
     return result
 
 
@@ -57,35 +84,101 @@ def get_player_fixtures(player_id):
     """
     result = MY_SESSION.get(
         constants.FANTASY_PLAYER_API_URL + str(player_id) + '/').json()
-    logger.debug('Got fixtures for player with id {}: {}...'.format(player_id, json.dumps(result)[:100]))
+    logger.debug('Got {} fixtures for player with id {}'.format(len(result['fixtures']), player_id))
     return result
 
 
-def login(username, password):
+def read_token_cache(path=constants.TOKEN_CACHE_PATH):
+    """
+    Read the cached bearer tokens, keyed by username.
+    """
+    try:
+        with open(path) as token_cache:
+            return json.load(token_cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_token_cache(cache, path=constants.TOKEN_CACHE_PATH):
+    """
+    Write the cached bearer tokens to disk, readable by the current user only.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as token_cache:
+        json.dump(cache, token_cache)
+    # os.open only applies the mode when creating the file
+    os.chmod(path, 0o600)
+
+
+def get_token_expiry(bearer_token):
+    """
+    Read the expiry time (epoch seconds) from the bearer token if it is a JWT.
+    """
+    try:
+        payload = bearer_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+def get_cached_token(username):
+    """
+    Get the cached bearer token for the given username, if it hasn't expired.
+    """
+    cached = read_token_cache().get(username)
+    if cached is None:
+        logger.debug('No cached bearer token for {}'.format(username))
+        return None
+    expires_at = cached.get('expires_at')
+    if expires_at is not None and expires_at - constants.TOKEN_EXPIRY_MARGIN < time.time():
+        logger.debug('Cached bearer token for {} has expired'.format(username))
+        return None
+    return cached['access_token']
+
+
+def cache_token(username, bearer_token, expires_at):
+    cache = read_token_cache()
+    cache[username] = {
+        'access_token': bearer_token,
+        'expires_at': expires_at or get_token_expiry(bearer_token)
+    }
+    write_token_cache(cache)
+
+
+def clear_cached_token(username):
+    cache = read_token_cache()
+    if cache.pop(username, None) is not None:
+        write_token_cache(cache)
+
+
+def fetch_token(username, password, record_video=False):
     """
     Login to the fantasy football web app via playwright to grab the bearer token.
     """
-    logger.info('Logging in to {} with username {}'.format(constants.LOGIN_URL, username))
+    # Only import playwright when we need it, it's slow to start up
+    from playwright.sync_api import sync_playwright
 
-    # Login via playwright to get the bearer token
+    logger.info('Fetching a new bearer token for {}'.format(username))
     with sync_playwright() as playwright:
         firefox = playwright.firefox # for some reason only firefox works in CI
         browser = firefox.launch()
-        context = browser.new_context(record_video_dir="playwright_videos/")
+        context = browser.new_context(record_video_dir="playwright_videos/" if record_video else None)
         page = context.new_page()
-        page.goto("https://fantasy.premierleague.com/")
+        page.goto(constants.FANTASY_URL + '/')
         page.get_by_role("button", name="Reject All").click()
         page.get_by_role("button", name="Log in").click()
         page.get_by_role("textbox", name="Email address").fill(username)
         page.get_by_role("textbox", name="Password").fill(password)
         page.get_by_role("button", name="Sign in", exact=True).click()
-        page.wait_for_url('https://fantasy.premierleague.com/');
-        bearerToken = page.evaluate("""
+        page.wait_for_url(constants.FANTASY_URL + '/');
+        oidc_user = page.evaluate("""
             () => {
                 for (i = 0; i < window.localStorage.length; i++) {
                     const key = window.localStorage.key(i);
                     if (key.startsWith("oidc")) {
-                        return JSON.parse(window.localStorage.getItem(key)).access_token
+                        const user = JSON.parse(window.localStorage.getItem(key));
+                        return {access_token: user.access_token, expires_at: user.expires_at};
                     }
                 }
             }
@@ -93,22 +186,98 @@ def login(username, password):
         context.close()
         browser.close()
 
-    MY_SESSION.headers.update({
-        'x-api-authorization': 'Bearer {}'.format(bearerToken),
+    cache_token(username, oidc_user['access_token'], oidc_user.get('expires_at'))
+    return oidc_user['access_token']
+
+
+def authenticate(username, password=None, record_video=False, force=False, entry=MY_ENTRY):
+    """
+    Set the bearer token on the entry's session, reusing the cached token where possible.
+    Returns True if the token came from the cache.
+    """
+    bearer_token = None if force else get_cached_token(username)
+    from_cache = bearer_token is not None
+    if from_cache:
+        logger.info('Using cached bearer token for {}'.format(username))
+    else:
+        if not password:
+            password = getpass.getpass(prompt='Password for {}: '.format(constants.LOGIN_URL))
+        bearer_token = fetch_token(username, password, record_video)
+    entry['session'].headers.update({
+        'x-api-authorization': 'Bearer {}'.format(bearer_token),
     })
+    entry.update(username=username, password=password, record_video=record_video)
+    return from_cache
 
-    dynamic_data = MY_SESSION.get(constants.FANTASY_API_DYNAMIC_URL).json()
-    static_data = MY_SESSION.get(constants.FANTASY_API_URL).json()
-    constants.NEXT_EVENT = next(event for event in static_data['events'] if event['finished']==False)
-    constants.SQUAD_ID = dynamic_data['player']['entry']
-    constants.SQUAD_URL += str(constants.SQUAD_ID) + '/'
+
+def authorised_request(method, url, entry=MY_ENTRY, **kwargs):
+    """
+    Make a request that needs the entry's bearer token.
+    If the token is rejected, log in again via playwright and retry once.
+    """
+    result = entry['session'].request(method, url, **kwargs)
+    if result.status_code in (401, 403) and 'username' in entry:
+        logger.info('Bearer token rejected with status {}, logging in again'.format(result.status_code))
+        clear_cached_token(entry['username'])
+        authenticate(entry['username'], entry['password'], entry['record_video'], force=True, entry=entry)
+        result = entry['session'].request(method, url, **kwargs)
+    return result
+
+
+def login(username, password=None, record_video=False, entry=MY_ENTRY):
+    """
+    Login to the fantasy football web app.
+    Playwright is only launched when there's no valid cached bearer token.
+    """
+    logger.info('Logging in to {} with username {}'.format(constants.LOGIN_URL, username))
+    start = time.perf_counter()
+    from_cache = authenticate(username, password, record_video, entry=entry)
+
+    dynamic_data = authorised_request('GET', constants.FANTASY_API_DYNAMIC_URL, entry).json()
+    update_next_event()
+    entry['id'] = dynamic_data['player']['entry']
+    entry['squad_url'] = constants.SQUAD_URL + str(entry['id']) + '/'
+    if entry is MY_ENTRY:
+        constants.SQUAD_ID = entry['id']
+    # log whether the browser was needed, so cold and warm logins can be compared
+    logger.info('Logged in as {} after {:.2f}s ({})'.format(
+        username, time.perf_counter() - start, 'cached token' if from_cache else 'browser login'))
+    return entry
+
+
+def get_csrf_token(entry=MY_ENTRY):
+    """
+    Get the CSRF token cookie the site set on the entry's session.
+    Cookies from a host without a dot (e.g. a local stub of the API) are stored under host.local.
+    """
+    for domain in (constants.FANTASY_DOMAIN, constants.FANTASY_DOMAIN + '.local'):
+        csrf_token = entry['session'].cookies.get('csrftoken', domain=domain)
+        if csrf_token is not None:
+            return csrf_token
+    return None
+
+
+def update_next_event(static_data=None):
+    """
+    Update the next event and transfer deadline from the static data.
+    The next event is the one flagged is_next, as the first unfinished event may be in progress.
+    Returns None if there isn't a next event (after the last gameweek's deadline).
+    """
+    if static_data is None:
+        static_data = MY_SESSION.get(constants.FANTASY_API_URL).json()
+    constants.NEXT_EVENT = next((event for event in static_data['events'] if event['is_next'] == True), None)
+    if constants.NEXT_EVENT is None:
+        logger.info('There is no next event, the season is over')
+        constants.TRANSFER_DEADLINE = None
+        return None
     constants.TRANSFER_DEADLINE = constants.NEXT_EVENT['deadline_time']
+    return constants.NEXT_EVENT
 
 
-def create_transfers_object(old_squad, new_squad, use_wildcard=False):
+def create_transfers_object(old_squad, new_squad, chip=None, entry=MY_ENTRY):
     """
     Given lists containing the old(/current)_squad and the new_squad,
-    calculate the new transfers object.
+    calculate the new transfers object, optionally playing the wildcard or free hit chip.
     """
     # Create our transfers object and players_in/out lists
     new_squad_ids = [player['id'] for player in new_squad]
@@ -118,10 +287,10 @@ def create_transfers_object(old_squad, new_squad, use_wildcard=False):
     players_out = [player for player in old_squad if player[
         'element'] not in new_squad_ids]
     transfer_object = {
-        'entry': constants.SQUAD_ID,
+        'entry': entry['id'],
         'event': constants.NEXT_EVENT['id'],
         'transfers': [],
-        'chip': 'wildcard' if use_wildcard else None
+        'chip': chip
     }
 
     # We sort the players_in and players_out list by player_type
@@ -143,32 +312,43 @@ def create_transfers_object(old_squad, new_squad, use_wildcard=False):
     return transfer_object
 
 
-def make_transfers(transfer_object):
+def make_transfers(transfer_object, entry=MY_ENTRY, current_squad=None):
     """
     Given a transfers object, make the corresponding transfers in the webapp.
+    The transfers are checked against the current squad first, and aren't made if they break the rules.
+    Returns None if the transfers weren't made.
     """
     # if we need to make transfers, then do so and return the response object
     # else return a generic success response (since we didn't need to do
     # anything!)
     if len(transfer_object['transfers']) > 0:
-        MY_SESSION.get('https://fantasy.premierleague.com/transfers')
-        csrf_token = MY_SESSION.cookies.get(
-            'csrftoken', domain='fantasy.premierleague.com')
+        if current_squad is None:
+            current_squad = get_transfers_squad(entry)
+        violations = rules.validate_transfers(transfer_object, current_squad, constants.PLAYERS)
+        if violations:
+            logger.error('Not making invalid transfers: {}'.format(violations))
+            return None
+
+        entry['session'].get(constants.FANTASY_URL + '/transfers')
+        csrf_token = get_csrf_token(entry)
 
         transfer_headers = {
             'X-CSRFToken': csrf_token,
             'X-Requested-With': 'XMLHttpRequest',
-            'Referer': 'https://fantasy.premierleague.com/transfers'
+            'Referer': constants.FANTASY_URL + '/transfers'
         }
 
-        result = MY_SESSION.post(
+        result = authorised_request(
+            'POST',
             constants.TRANSFER_URL,
+            entry,
             headers=transfer_headers,
             json=transfer_object
         )
 
         if result.status_code != 200:
             logger.error('Error making transfers: {}'.format(result.json()))
+            return None
     else:
         response_success = requests.Response
         response_success.status_code = 200
@@ -177,23 +357,30 @@ def make_transfers(transfer_object):
     return result
 
 
-def set_starting_lineup(starting_lineup):
+def set_starting_lineup(starting_lineup, entry=MY_ENTRY, squad_ids=None):
     """
     Set the starting lineup correctly in the webapp.
+    The lineup isn't set if it breaks the rules, or isn't made of the squad's players (if squad_ids is given).
     """
+    violations = rules.validate_lineup(starting_lineup, constants.PLAYERS, squad_ids)
+    if violations:
+        logger.error('Not setting invalid starting lineup: {}'.format(violations))
+        return None
+
     # Make a GET request to get the correct cookies
-    MY_SESSION.get(constants.SQUAD_URL)
-    csrf_token = MY_SESSION.cookies.get(
-        'csrftoken', domain='fantasy.premierleague.com')
+    authorised_request('GET', entry['squad_url'], entry)
+    csrf_token = get_csrf_token(entry)
 
     starting_lineup_headers = {
         'X-CSRFToken': csrf_token,
         'X-Requested-With': 'XMLHttpRequest',
-        'Referer': 'https://fantasy.premierleague.com/my-team'
+        'Referer': constants.FANTASY_URL + '/my-team'
     }
 
-    result = MY_SESSION.post(
-        constants.SQUAD_URL,
+    result = authorised_request(
+        'POST',
+        entry['squad_url'],
+        entry,
         headers=starting_lineup_headers,
         json=starting_lineup
     )